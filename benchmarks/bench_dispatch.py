@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Per-packet cost of BugOne.process_data with 0, 10 and 1000 registered
+# callbacks (INFO logging disabled, as in production)
+
+import argparse
+import logging
+import time
+
+import framegen
+import bugone
+
+
+def noop(*args):
+    pass
+
+
+def run(frames, callbacks, nodes):
+    logger = logging.getLogger("BugOneBench")
+    logger.setLevel(logging.WARNING)
+    bug = bugone.BugOne(None, False, 38400, logger, noop)
+    for i in range(callbacks):
+        nodeid = 1 + i % nodes
+        if i % 2:
+            bug.register_device(nodeid, 1 + (i // nodes) % 3, noop)
+        else:
+            bug.register_node(nodeid, noop, noop)
+    start = time.perf_counter()
+    for frame in frames:
+        bug.process_data(frame)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BugOne dispatch benchmark")
+    parser.add_argument("-n","--frames",type=int,default=100000)
+    parser.add_argument("--nodes",type=int,default=10)
+    args = parser.parse_args()
+
+    frames = list(framegen.frames(args.frames, nodes = args.nodes))
+    for callbacks in (0, 10, 1000):
+        elapsed = run(frames, callbacks, args.nodes)
+        print("%4d callbacks: %.2f us/packet, %.0f packets/s" % \
+            (callbacks, elapsed / len(frames) * 1e6, len(frames) / elapsed))
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# End-to-end benchmark
+# A synthetic sniffer writes BugOne frames to a pty, which the real bridge
+# (bugone_zmq) opens as its serial port. The real Graphite and InfluxDB
+# clients write to local stub carbon and InfluxDB servers, which timestamp
+# every point they receive.
+# Each value sent is unique per device (within 65536 values), so that the
+# serial-to-sink latency of every point can be computed.
+# Each process serves its metrics over HTTP: the values it received and
+# wrote during the run are reported too.
+
+import argparse
+import http.server
+import json
+import os
+import pickle
+import pty
+import random
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import framegen
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+class Sink():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = []
+
+    def add(self, nodeid, devid, value):
+        now = time.time()
+        with self.lock:
+            self.received.append((now, nodeid, devid, int(value)))
+
+
+class CarbonHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        buf = b""
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            buf += data
+            while len(buf) >= 4:
+                length = struct.unpack("!L", buf[:4])[0]
+                if len(buf) < 4 + length:
+                    break
+                for (path, (timestamp, value)) in pickle.loads(buf[4:4 + length]):
+                    # bugone.node<nodeid>.dev<devid>
+                    (prefix, node, dev) = path.split(".")
+                    self.server.sink.add(int(node[4:]), int(dev[3:]), value)
+                buf = buf[4 + length:]
+
+
+class InfluxHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        for line in body.decode("utf-8").split("\n"):
+            # dev<devid>,location=node<nodeid>,nodeid=..,devid=.. value=<v>i <ts>
+            (key, field, timestamp) = line.split(" ")
+            tags = dict(t.split("=") for t in key.split(",")[1:])
+            self.server.sink.add(int(tags["nodeid"]), int(tags["devid"]), field[6:].rstrip("i"))
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(cls, handler):
+    server = cls(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.sink = Sink()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def rss_kb(pid):
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def write_configs(workdir, tty, pub_port, carbon_port, influx_port, nodes, values_per_packet, wire_format, metrics_port = None):
+    # With metrics_port, the bridge serves its metrics on metrics_port, the
+    # graphite, influxdb and unified clients on the next ones
+    with open(os.path.join(workdir, "bugnet.yaml"), "w") as f:
+        f.write("---\nname: bench\nnodes:\n")
+        for n in range(1, nodes + 1):
+            f.write("   - location: node%d\n     address: node%d\n     nodeid: %d\n" % (n, n, n))
+        f.write("devices:\n")
+        for n in range(1, nodes + 1):
+            for d in range(1, values_per_packet + 1):
+                # Unknown type: the raw value is forwarded
+                f.write("   - type: dev%d\n     nodeid: %d\n     devid: %d\n" % (d, n, d))
+        f.write("...\n")
+    common = """[General]
+log_file=%s
+
+[BugOne]
+bugone_network_db=%s
+serial_port=%s
+baudrate=38400
+reconnect=no
+
+[Server]
+address=127.0.0.1
+port=%d
+format=%s
+""" % (os.path.join(workdir, "bugone.log"), os.path.join(workdir, "bugnet.yaml"), tty, pub_port, wire_format)
+
+    def metrics(offset):
+        if metrics_port is None:
+            return ""
+        return "\n[Metrics]\naddress=127.0.0.1\nhttp_port=%d\n" % (metrics_port + offset)
+
+    with open(os.path.join(workdir, "bridge.conf"), "w") as f:
+        f.write(common + metrics(0))
+    with open(os.path.join(workdir, "graphite.conf"), "w") as f:
+        f.write(common + metrics(1) + "\n[Graphite]\ngraph_address=127.0.0.1\nport=%d\nflush_interval=100\n" % carbon_port)
+    with open(os.path.join(workdir, "influxdb.conf"), "w") as f:
+        f.write(common + metrics(2) + "\n[InfluxDB]\naddress=127.0.0.1\nport=%d\nssl=no\ndatabase=bugone\nuser=\npassword=\nflush_interval=100\n" % influx_port)
+    with open(os.path.join(workdir, "client.conf"), "w") as f:
+        f.write(common + metrics(3) + "\n[Client]\nsinks=Graphite,InfluxDB\n" + \
+            "\n[Graphite]\ngraph_address=127.0.0.1\nport=%d\nflush_interval=100\n" % carbon_port + \
+            "\n[InfluxDB]\naddress=127.0.0.1\nport=%d\nssl=no\ndatabase=bugone\nuser=\npassword=\nflush_interval=100\n" % influx_port)
+
+
+def spawn(script, conf):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.path.join(ROOT, "bugone_bridge") + os.pathsep + env.get("PYTHONPATH", "")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, script), "-c", conf],
+            env = env, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+
+def fetch_metrics(port):
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%d/" % port, timeout = 2) as r:
+            return json.loads(r.read().decode("utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def io_counts(snapshot):
+    # (values received, values written) by a process, from its metrics
+    if snapshot is None:
+        return None
+    received = sum(snapshot["nodes"].get("values", {}).values())
+    gauges = snapshot["gauges"]
+    written = sum(gauges.get(name) or 0 for name in ("zmq.sent", "carbon.sent", "influx.written"))
+    return (received, written)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BugOne end-to-end benchmark")
+    parser.add_argument("--nodes",type=int,default=50)
+    parser.add_argument("--values",type=int,default=3,help="Values per packet (at most 5)")
+    parser.add_argument("--error-rate",type=float,default=0.0)
+    parser.add_argument("--rate",type=float,default=500,help="Frames per second sent by the fake sniffer (0: as fast as possible)")
+    parser.add_argument("--duration",type=float,default=10)
+    parser.add_argument("--format",default="legacy")
+    parser.add_argument("--port",type=int,default=40777,help="zMQ publisher port")
+    parser.add_argument("--metrics-port",type=int,default=40780,help="First metrics HTTP port (one per process)")
+    parser.add_argument("--unified",action="store_true",help="Use the unified client (bugone_client) for both sinks")
+    args = parser.parse_args()
+
+    carbon = start_server(socketserver.ThreadingTCPServer, CarbonHandler)
+    influx = start_server(http.server.ThreadingHTTPServer, InfluxHandler)
+    (master, slave) = pty.openpty()
+    workdir = tempfile.mkdtemp(prefix = "bugone-bench-")
+    write_configs(workdir, os.ttyname(slave), args.port, carbon.server_address[1], influx.server_address[1],
+            args.nodes, args.values, args.format, args.metrics_port)
+
+    procs = {
+        "bridge": spawn("bugone_zmq/bugone_zmq.py", os.path.join(workdir, "bridge.conf")),
+    }
+    if args.unified:
+        procs["client"] = spawn("bugone_client/bugone_client.py", os.path.join(workdir, "client.conf"))
+    else:
+        procs["graphite"] = spawn("bugone_client_graphite/bugone_client_graphite.py", os.path.join(workdir, "graphite.conf"))
+        procs["influxdb"] = spawn("bugone_client_influxdb/bugone_client_influxdb.py", os.path.join(workdir, "influxdb.conf"))
+    metrics_ports = {"bridge": args.metrics_port, "graphite": args.metrics_port + 1,
+            "influxdb": args.metrics_port + 2, "client": args.metrics_port + 3}
+    # Let the bridge open the pty and the subscribers connect
+    time.sleep(2)
+    before = dict((name, io_counts(fetch_metrics(metrics_ports[name]))) for name in procs)
+
+    rnd = random.Random(0)
+    sent = {}
+    frames = 0
+    # One packet counter per node, as real nodes have
+    counters = [0] * (args.nodes + 1)
+    batch = 10
+    start = time.time()
+    while time.time() - start < args.duration:
+        chunk = []
+        now = time.time()
+        for i in range(batch):
+            src = 1 + frames % args.nodes
+            vals = []
+            for d in range(1, args.values + 1):
+                v = (frames * args.values + d) & 0xFFFF
+                vals.append((d, 0, v))
+                sent[(src, d, v)] = now
+            counters[src] = (counters[src] + 1) & 0xFFFF
+            frame = framegen.values_packet(src, counters[src], vals)
+            raw = framegen.wire(frame)
+            if args.error_rate and rnd.random() < args.error_rate:
+                raw = framegen.corrupt(raw, rnd)
+            chunk.append(raw)
+            frames += 1
+        os.write(master, b"".join(chunk))
+        if args.rate:
+            delay = start + frames / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    elapsed = time.time() - start
+    values = frames * args.values
+    # Wait for the pipeline to drain
+    time.sleep(2)
+
+    after = dict((name, fetch_metrics(metrics_ports[name])) for name in procs)
+    rss = dict((name, rss_kb(p.pid)) for (name, p) in procs.items())
+    for p in procs.values():
+        p.terminate()
+    for p in procs.values():
+        p.wait()
+
+    print("sent: %d frames (%.0f frames/s), %d values (%.0f values/s) for %d nodes" % \
+        (frames, frames / elapsed, values, values / elapsed, args.nodes))
+    for (name, server) in (("graphite", carbon), ("influxdb", influx)):
+        with server.sink.lock:
+            received = list(server.sink.received)
+        latencies = []
+        for (t, nodeid, devid, value) in received:
+            if (nodeid, devid, value) in sent:
+                latencies.append(t - sent[(nodeid, devid, value)])
+        print("%s: %d values (%.0f values/s, %.1f%% delivered), latency p50 %.1f ms, p99 %.1f ms" % \
+            (name, len(received), len(received) / elapsed, 100.0 * len(received) / values if values else 0,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
+    for name in procs:
+        (start_counts, end_counts) = (before[name], io_counts(after[name]))
+        if start_counts is None or end_counts is None:
+            print("%s: no metrics" % name)
+            continue
+        (received, written) = (end_counts[0] - start_counts[0], end_counts[1] - start_counts[1])
+        print("%s: received %d values (%.0f values/s), wrote %d (%.0f values/s)" % \
+            (name, received, received / elapsed, written, written / elapsed))
+    if after["bridge"] is not None:
+        sequence = after["bridge"]["gauges"].get("sequence") or {}
+        print("bridge: %d packets reported lost by the sequence tracker" % sum(s["lost"] for s in sequence.values()))
+    for (name, kb) in rss.items():
+        print("%s RSS: %.1f MB" % (name, kb / 1024))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# LivenessTracker cost: seen() per packet and check() per second of
+# simulated time, with a simulated clock. Each node reports every 10 to 60
+# seconds, and a tenth of them stop reporting half way.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bugone_bridge"))
+
+import bugone
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Node liveness tracker benchmark")
+    parser.add_argument("--nodes",type=int,default=10000,help="Number of nodes (the BugOne protocol has 256 at most)")
+    parser.add_argument("--duration",type=int,default=3600,help="Simulated seconds")
+    args = parser.parse_args()
+
+    now = [0.0]
+    transitions = [0, 0]
+
+    def emit(nodeid, status):
+        transitions[status] += 1
+
+    rnd = random.Random(0)
+    tracker = bugone.LivenessTracker(emit, nodes = args.nodes, clock = lambda: now[0])
+    period = [rnd.randint(10, 60) for n in range(args.nodes)]
+    dying = set(rnd.sample(range(args.nodes), args.nodes // 10))
+    # Nodes due at each second of the simulation
+    due = [[] for t in range(args.duration + 61)]
+    for n in range(args.nodes):
+        due[rnd.randint(0, period[n])].append(n)
+
+    (packets, seen_time, check_time) = (0, 0.0, 0.0)
+    for t in range(args.duration):
+        now[0] = float(t)
+        nodes = due[t]
+        start = time.perf_counter()
+        for n in nodes:
+            tracker.seen(n)
+        seen_time += time.perf_counter() - start
+        packets += len(nodes)
+        for n in nodes:
+            if not (n in dying and t > args.duration // 2):
+                due[t + period[n]].append(n)
+        start = time.perf_counter()
+        tracker.check()
+        check_time += time.perf_counter() - start
+
+    print("%d nodes, %d packets over %d simulated seconds" % (args.nodes, packets, args.duration))
+    print("seen: %.2f us/packet, check: %.1f us/s of simulated time" % \
+        (seen_time / packets * 1e6, check_time / args.duration * 1e6))
+    print("transitions: %d active, %d inactive (%d nodes stopped)" % (transitions[1], transitions[0], len(dying)))
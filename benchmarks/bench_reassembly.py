@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Microbenchmark of the serial frame reassembly
+# Reports frames/s on a clean stream, and recovered frames/s on noisy input
+
+import argparse
+import time
+
+import framegen
+import bugoneframe
+
+
+def run(stream, chunk):
+    count = [0]
+    def on_frame(frame):
+        count[0] += 1
+    r = bugoneframe.FrameReassembler(on_frame, timeout = 0)
+    start = time.perf_counter()
+    for i in range(0, len(stream), chunk):
+        r.feed(stream[i:i + chunk], 0)
+    elapsed = time.perf_counter() - start
+    return count[0], elapsed, r
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BugOne frame reassembly benchmark")
+    parser.add_argument("-n","--frames",type=int,default=100000)
+    parser.add_argument("-e","--error-rate",type=float,default=0.05)
+    parser.add_argument("--chunk",type=int,default=64,help="Bytes per data_received call")
+    args = parser.parse_args()
+
+    clean = framegen.stream(args.frames)
+    count, elapsed, r = run(clean, args.chunk)
+    print("clean: %d frames in %.3fs, %.0f frames/s" % (count, elapsed, count / elapsed))
+
+    noisy = framegen.stream(args.frames, error_rate = args.error_rate)
+    count, elapsed, r = run(noisy, args.chunk)
+    print("noisy (%.1f%% errors): %d/%d frames in %.3fs, %.0f recovered frames/s, %d resyncs, %d bytes discarded" % \
+        (args.error_rate * 100, count, args.frames, elapsed, count / elapsed, r.errors, r.discarded))
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Serial reconnection benchmark
+# The bridge (bugone_zmq, with reconnect=yes) opens a symlink to a pty, which
+# stands for the sniffer device. To unplug the sniffer, the symlink is
+# removed and the pty closed. To plug it again, a new pty is created and the
+# symlink put back. A fake sniffer writes frames to the current pty all the
+# time, and a zMQ subscriber measures the time from the symlink being
+# created to the first message published by the bridge.
+
+import argparse
+import os
+import pty
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import zmq
+
+import bench_e2e
+import framegen
+
+
+class FakeSniffer():
+
+    def __init__(self, link, rate):
+        self.link = link
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.master = None
+        self.slave = None
+        self.frames = 0
+
+    def plug(self):
+        (master, slave) = pty.openpty()
+        with self.lock:
+            (self.master, self.slave) = (master, slave)
+        os.symlink(os.ttyname(slave), self.link)
+        return time.time()
+
+    def unplug(self):
+        os.unlink(self.link)
+        with self.lock:
+            (master, slave) = (self.master, self.slave)
+            (self.master, self.slave) = (None, None)
+        os.close(slave)
+        os.close(master)
+
+    def run(self):
+        while True:
+            frame = framegen.wire(framegen.values_packet(1 + self.frames % 10, self.frames & 0xFFFF, [(1, 0, self.frames & 0xFFFF)]))
+            with self.lock:
+                if self.master is not None:
+                    try:
+                        os.write(self.master, frame)
+                    except OSError:
+                        pass
+            self.frames += 1
+            time.sleep(1.0 / self.rate)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BugOne serial reconnection benchmark")
+    parser.add_argument("--cycles",type=int,default=10,help="Number of unplug/plug cycles")
+    parser.add_argument("--down",type=float,default=0.5,help="Minimum time (s) the sniffer stays unplugged (up to 0.2s are added at random)")
+    parser.add_argument("--rate",type=float,default=200,help="Frames per second sent by the fake sniffer")
+    parser.add_argument("--port",type=int,default=40787,help="zMQ publisher port")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = "bugone-bench-")
+    link = os.path.join(workdir, "ttyUSB0")
+    sniffer = FakeSniffer(link, args.rate)
+    sniffer.plug()
+    bench_e2e.write_configs(workdir, link, args.port, 0, 0, 10, 1, "legacy")
+    with open(os.path.join(workdir, "bridge.conf")) as f:
+        conf = f.read().replace("reconnect=no", "reconnect=yes")
+    with open(os.path.join(workdir, "bridge.conf"), "w") as f:
+        f.write(conf)
+
+    context = zmq.Context()
+    subscriber = context.socket(zmq.SUB)
+    subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+    subscriber.connect("tcp://127.0.0.1:%d" % args.port)
+    bridge = bench_e2e.spawn("bugone_zmq/bugone_zmq.py", os.path.join(workdir, "bridge.conf"))
+    threading.Thread(target=sniffer.run, daemon=True).start()
+    if not subscriber.poll(10000):
+        print("No message from the bridge")
+        bridge.terminate()
+        sys.exit(1)
+
+    rnd = random.Random(0)
+    latencies = []
+    for cycle in range(args.cycles):
+        sniffer.unplug()
+        time.sleep(args.down + rnd.random() * 0.2)
+        # Drop what was published before the unplug
+        while subscriber.poll(0):
+            subscriber.recv()
+        plugged = sniffer.plug()
+        if not subscriber.poll(10000):
+            print("cycle %d: no message 10s after the sniffer was plugged" % cycle)
+            continue
+        latencies.append(time.time() - plugged)
+        time.sleep(0.2)
+
+    alive = bridge.poll() is None
+    bridge.terminate()
+    bridge.wait()
+    print("%d/%d reconnections, bridge %s" % (len(latencies), args.cycles, "alive" if alive else "exited"))
+    print("plug to first published frame: p50 %.1f ms, p99 %.1f ms, max %.1f ms" % \
+        (bench_e2e.percentile(latencies, 50) * 1000, bench_e2e.percentile(latencies, 99) * 1000, max(latencies or [float("nan")]) * 1000))
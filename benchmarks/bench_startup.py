@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Startup time benchmark
+# Each tool is started runs times, and the time until it is ready is
+# measured:
+# - bugone_zmq: until it publishes a message for a frame written to its pty
+# - the clients: until they connect to a zMQ publisher bound by the
+#   benchmark (after their configuration and network description are
+#   loaded)
+# The first run starts without a network description cache (see
+# bugoneregistry), the next ones with it.
+
+import argparse
+import os
+import pty
+import statistics
+import tempfile
+import time
+
+import zmq
+import zmq.utils.monitor
+
+import bench_e2e
+import framegen
+
+TOOLS = (
+        ("bugone_zmq", "bugone_zmq/bugone_zmq.py", "bridge.conf"),
+        ("graphite", "bugone_client_graphite/bugone_client_graphite.py", "graphite.conf"),
+        ("influxdb", "bugone_client_influxdb/bugone_client_influxdb.py", "influxdb.conf"),
+        ("print", "bugone_client_print/bugone_client_print.py", "graphite.conf"),
+        )
+
+
+def wait_bridge(context, port, master, timeout = 10.0):
+    subscriber = context.socket(zmq.SUB)
+    subscriber.setsockopt(zmq.SUBSCRIBE, b"")
+    subscriber.connect("tcp://127.0.0.1:%d" % port)
+    deadline = time.time() + timeout
+    counter = 0
+    try:
+        while time.time() < deadline:
+            # A new packet counter each time, so that none is dropped as a
+            # retransmission
+            counter += 1
+            try:
+                os.write(master, framegen.wire(framegen.values_packet(1, counter, [(1, 0, 1)])))
+            except BlockingIOError:
+                # Nobody reads the pty yet and its buffer is full
+                pass
+            if subscriber.poll(5):
+                return time.time()
+        return None
+    finally:
+        subscriber.close(0)
+
+
+def wait_client(monitor, timeout = 10.0):
+    if not monitor.poll(timeout * 1000):
+        return None
+    while True:
+        event = zmq.utils.monitor.recv_monitor_message(monitor)
+        if event["event"] == zmq.EVENT_ACCEPTED:
+            return time.time()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BugOne startup time benchmark")
+    parser.add_argument("--runs",type=int,default=5)
+    parser.add_argument("--nodes",type=int,default=50,help="Nodes in the network description")
+    parser.add_argument("--values",type=int,default=5,help="Devices per node")
+    parser.add_argument("--port",type=int,default=40797,help="zMQ publisher port")
+    args = parser.parse_args()
+
+    context = zmq.Context()
+    (master, slave) = pty.openpty()
+    workdir = tempfile.mkdtemp(prefix = "bugone-bench-")
+    bench_e2e.write_configs(workdir, os.ttyname(slave), args.port, 1, 1, args.nodes, args.values, "legacy")
+    os.set_blocking(master, False)
+    # Stands for the bridge when the clients start
+    publisher = context.socket(zmq.PUB)
+    monitor = publisher.get_monitor_socket(zmq.EVENT_ACCEPTED)
+
+    for (name, script, conf) in TOOLS:
+        # The bridge binds the port itself, the clients need the publisher
+        if name != "bugone_zmq" and not publisher.get(zmq.LAST_ENDPOINT):
+            publisher.bind("tcp://127.0.0.1:%d" % args.port)
+        cache = [os.path.join(workdir, n) for n in os.listdir(workdir) if n.endswith(".cache")]
+        for path in cache:
+            os.unlink(path)
+        times = []
+        for run in range(args.runs):
+            start = time.time()
+            proc = bench_e2e.spawn(script, os.path.join(workdir, conf))
+            if name == "bugone_zmq":
+                ready = wait_bridge(context, args.port, master)
+            else:
+                ready = wait_client(monitor)
+            proc.terminate()
+            proc.wait()
+            times.append(None if ready is None else ready - start)
+        if None in times:
+            print("%s: not ready after 10s" % name)
+            continue
+        print("%s: first start %.0f ms, next starts median %.0f ms (min %.0f ms)" % \
+            (name, times[0] * 1000, statistics.median(times[1:] or times) * 1000, min(times) * 1000))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Column store (bugonestore): append rate, then range queries and
+# downsampling over a year of readings of one device
+
+import argparse
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bugone_bridge"))
+
+import bugonestore
+
+NS = 1000000000
+YEAR = 365 * 24 * 3600
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Column store benchmark")
+    parser.add_argument("--interval",type=float,default=60,help="Seconds between two readings")
+    parser.add_argument("--chunk-points",type=int,default=65536)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix = "bugone-bench-")
+    try:
+        count = int(YEAR / args.interval)
+        start_ns = 1500000000 * NS
+        step = int(args.interval * NS)
+        store = bugonestore.ColumnStore(workdir, args.chunk_points)
+        start = time.perf_counter()
+        for i in range(count):
+            store.append(1, 1, start_ns + i * step, 20 + 5 * math.sin(i / 1000))
+        elapsed = time.perf_counter() - start
+        store.close()
+        print("append: %d points in %.2fs (%.0f points/s)" % (count, elapsed, count / elapsed))
+
+        reader = bugonestore.ColumnReader(workdir)
+        # First pass maps the chunks, the next ones are measured
+        reader.query(1, 1)
+        runs = 20
+        start = time.perf_counter()
+        for i in range(runs):
+            parts = reader.query(1, 1, start_ns, start_ns + YEAR * NS)
+            total = sum(float(v.sum(dtype = numpy.float64)) for (t, v) in parts)
+        elapsed = (time.perf_counter() - start) / runs
+        print("query + sum over a year (%d chunks): %.2f ms" % (len(parts), elapsed * 1000))
+
+        start = time.perf_counter()
+        for i in range(runs):
+            parts = reader.query(1, 1, start_ns + 100 * step, start_ns + 1540 * step)
+        elapsed = (time.perf_counter() - start) / runs
+        print("query of a day: %.3f ms" % (elapsed * 1000))
+
+        for (name, bucket) in (("hourly", 3600), ("daily", 86400)):
+            start = time.perf_counter()
+            for i in range(runs):
+                (starts, counts, mean, vmin, vmax) = reader.downsample(1, 1, start_ns, start_ns + YEAR * NS, bucket * NS)
+            elapsed = (time.perf_counter() - start) / runs
+            print("downsample %s over a year (%d buckets): %.2f ms" % (name, len(starts), elapsed * 1000))
+    finally:
+        shutil.rmtree(workdir)
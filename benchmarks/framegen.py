@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Synthetic BugOne traffic, shared by the benchmarks
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bugone_bridge"))
+
+import bugonehelper
+import bugoneframe
+
+
+def values_packet(src, counter, values, dest = 0):
+    # values is a list of (srcDevice, destDevice, valueInt)
+    packet = bytearray([src, dest, 0, bugonehelper.PACKET_VALUES])
+    packet += counter.to_bytes(2, byteorder = "little")
+    for (srcDevice, destDevice, valueInt) in values:
+        packet += bytes([srcDevice, destDevice, ord('I')])
+        packet += valueInt.to_bytes(2, byteorder = "little")
+    packet = packet[:bugoneframe.PACKET_LENGTH]
+    packet += bytes(bugoneframe.PACKET_LENGTH - len(packet))
+    c = 0
+    for b in packet:
+        c ^= b
+    return bytes(packet) + bytes([c])
+
+
+def wire(frame):
+    # Frame as sent by the sniffer on the serial line
+    return bytes([bugoneframe.PACKET_LENGTH]) + frame
+
+
+def frames(count, nodes = 10, values_per_packet = 3, seed = 0):
+    rnd = random.Random(seed)
+    counters = [0] * (nodes + 1)
+    for i in range(count):
+        src = 1 + i % nodes
+        counters[src] = (counters[src] + 1) & 0xFFFF
+        values = [(devid, 0, rnd.randrange(0x10000)) for devid in range(1, values_per_packet + 1)]
+        yield values_packet(src, counters[src], values)
+
+
+def corrupt(raw, rnd):
+    # Corrupt a byte, lose a few bytes or add line noise before the frame
+    raw = bytearray(raw)
+    kind = rnd.randrange(3)
+    if kind == 0:
+        raw[rnd.randrange(len(raw))] ^= 1 << rnd.randrange(8)
+    elif kind == 1:
+        cut = rnd.randrange(1, len(raw))
+        del raw[cut:cut + rnd.randrange(1, 8)]
+    else:
+        raw[0:0] = bytes(rnd.randrange(256) for i in range(rnd.randrange(1, 40)))
+    return bytes(raw)
+
+
+def stream(count, nodes = 10, values_per_packet = 3, error_rate = 0.0, seed = 0):
+    # Serial byte stream, where a error_rate share of the frames is corrupted
+    rnd = random.Random(seed)
+    out = bytearray()
+    for frame in frames(count, nodes, values_per_packet, seed):
+        raw = wire(frame)
+        if error_rate and rnd.random() < error_rate:
+            raw = corrupt(raw, rnd)
+        out += raw
+    return bytes(out)
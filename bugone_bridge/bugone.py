@@ -23,98 +23,642 @@ along with this program.  If not, see
 
 
 import time
+import array
 import asyncio
-import serial.aio
+import collections
+import glob
+import os
 import bugonehelper
+import bugoneframe
+import bugonemetrics
 import logging
-import logging.handlers
 
+# Ports scanned for a sniffer which reappeared under another number
+CANDIDATE_PORTS = ("/dev/ttyUSB*", "/dev/ttyACM*")
 
 
 class BugOneProtocol(asyncio.Protocol):
 
-    def __init__(self, cb_process,log = None):
+    def __init__(self, cb_process,log = None, timeout = 0.05, metrics = None):
         if log :
             self.log = log
 
         self._process_data = cb_process
-
-        self.waiting = False
-        self.length = 0
-        self.data = b""
-        self.received = 0
-        self.errors = 0
-
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("bridge")
+        # The reassembler records the serial_read, reassembly and checksum
+        # stages, process_data is recorded by BugOne
+        self.reassembler = bugoneframe.FrameReassembler(self._frame_received, timeout, metrics = metrics)
+        # SnifferPort this protocol reads from, if any
+        self.sniffer = None
+        # Time (ns since Epoch) the data being processed was received
+        self.arrival_ns = 0
+
+    @property
+    def received(self):
+        return self.reassembler.received
+
+    @property
+    def errors(self):
+        return self.reassembler.errors
 
     def connection_made(self, transport):
         self.transport = transport
         self.log.debug("Serial port opened")
-        transport.serial.rts = False
+        if self.sniffer:
+            self.sniffer.connected = True
+        try:
+            transport.serial.rts = False
+        except OSError:
+            # Not a real serial port (e.g. a pty)
+            self.log.debug("Cannot clear RTS")
 
     def connection_lost(self, exc):
         self.log.debug("Port closed")
-        ayncio.get_event_loop().stop() # No reconnect for now
+        if self.sniffer:
+            self.sniffer.connected = False
+            # Wakes up the supervisor of the port (see BugOne._supervise)
+            if self.sniffer.lost and not self.sniffer.lost.done():
+                self.sniffer.lost.set_result(exc)
 
     def data_received(self, data):
-        while len(data) > 0:
-            # Check if we are already waiting for a packet
-            if not self.waiting:
-                self.length = data[0]
-                data = data[1:]
-                # BugOne packets are always 32 bytes long
-                if self.length != 32:
-                    self.log.error("Received impossible length (%s), we should discard" % str(self.length))
-                    self.length = 32
-                    self.errors = self.errors + 1
-                    # TODO : add timeout to discard
-                self.length += 1 # Add checksum
-                self.waiting = True
-                self.data = b""
-
-            # We still have self.length bytes to read, and we just received len(data)
-            to_read = min(len(data), self.length)
-            if to_read != 0:
-                last_idx = to_read
-                self.data = self.data + data[0:last_idx]
-                data = data[last_idx:]
-                self.length -= to_read
-
-            if self.length == 0: 
-                self.received = self.received + 1
-                c = 0
-                for i in self.data:
-                    c ^= i
-                if c != 0:
-                    self.log.error('Erroneous data...')
-                    self.errors = self.errors + 1
-                self._process_data(self.data)
-                self.log.debug('%s received, %s errors' % (self.received, self.errors))
-                self.waiting = False
-                self.data = b""
-            if (len(data)) != 0:
-                self.log.debug("Proceed with next data (length: %s)" % (len(data)))
+        self.arrival_ns = time.time_ns()
+        errors = self.reassembler.errors
+        self.reassembler.feed(data)
+        if self.reassembler.errors != errors:
+            self.log.error("Lost synchronization on serial stream, %s bytes discarded so far", self.reassembler.discarded)
+
+    def _frame_received(self, frame):
+        self._process_data(frame)
+        self.log.debug('%s received, %s errors', self.reassembler.received, self.reassembler.errors)
 
     def send_data(self,data):
-        self.log.debug('Sending data', repr(data))
-        transport.write(data)
+        self.log.debug("Sending data %s", repr(data))
+        self.transport.write(data)
+
+class SnifferPort():
+
+    # Health and throughput of one serial port
+    # frames counts frames received on this port, duplicates the ones which
+    # were already heard by another sniffer
+    # device is the port actually opened (it differs from name when the
+    # sniffer was found under another number, see BugOne)
+    # appeared is the time (monotonic) the device was found again after it
+    # was lost, until the first frame is received from it
+
+    def __init__(self, name):
+        self.name = name
+        self.device = name
+        self.protocol = None
+        self.connected = False
+        self.lost = None
+        self.frames = 0
+        self.duplicates = 0
+        self.last_frame = None
+        self.reconnects = 0
+        self.appeared = None
+        self.reconnect_ms = None
+
+    def stats(self):
+        r = self.protocol.reassembler if self.protocol else None
+        return {
+                "connected": self.connected,
+                "device": self.device,
+                "reconnects": self.reconnects,
+                "reconnect_ms": self.reconnect_ms,
+                "frames": self.frames,
+                "duplicates": self.duplicates,
+                "resyncs": r.errors if r else 0,
+                "checksum_errors": r.bad_checksums if r else 0,
+                "last_frame_age": (time.monotonic() - self.last_frame) if self.last_frame else None,
+                }
+
+
+class FrameDeduplicator():
+
+    # Drops frames whose (src, counter) was already seen less than window
+    # seconds ago, e.g. a packet heard by several sniffers.
+    # Entries are kept in arrival order, so expiring them only looks at the
+    # oldest ones. At most max_entries are remembered.
+
+    def __init__(self, window = 2.0, max_entries = 65536, clock = time.monotonic):
+        self.window = window
+        self.max_entries = max_entries
+        self._clock = clock
+        self.seen = collections.OrderedDict()
+        self.duplicates = 0
+
+    def is_duplicate(self, frame, now = None):
+        if now is None:
+            now = self._clock()
+        seen = self.seen
+        while seen:
+            (key, t) = next(iter(seen.items()))
+            if now - t <= self.window and len(seen) < self.max_entries:
+                break
+            seen.popitem(last = False)
+        key = (frame[0], bugonehelper.getPacketCounter(frame))
+        if key in seen:
+            self.duplicates += 1
+            return True
+        seen[key] = now
+        return False
+
+
+class SequenceTracker():
+
+    # Follows the packet counter of each node, in arrays indexed by nodeid.
+    # A counter which does not follow the previous one is a gap (the missing
+    # packets are counted as lost), a wrap (0xFFFF -> 0) or a reset of the
+    # node. A reset is a counter going backwards, a counter of reset_counter
+    # or less which is more than max_wrap_gap packets after the previous one
+    # (a node rebooting from a high counter, not a wrap), or any jump after
+    # more than silence seconds without a packet: no loss is counted then.
+    # The same counter with the same content is a retransmission, which
+    # check() rejects. The same counter with a different content is accepted.
+
+    def __init__(self, reset_counter = 2, max_wrap_gap = 256, silence = 600, clock = time.monotonic):
+        self.reset_counter = reset_counter
+        self.max_wrap_gap = max_wrap_gap
+        self.silence = silence
+        self._clock = clock
+        self.last_counter = array.array("l", [-1] * 256)
+        self.last_seen = array.array("d", bytes(8 * 256))
+        self.last_frame = [None] * 256
+        self.received = array.array("Q", bytes(8 * 256))
+        self.lost = array.array("Q", bytes(8 * 256))
+        self.gaps = array.array("Q", bytes(8 * 256))
+        self.duplicates = array.array("Q", bytes(8 * 256))
+        self.wraps = array.array("Q", bytes(8 * 256))
+        self.resets = array.array("Q", bytes(8 * 256))
+
+    def check(self, frame):
+        # Returns False if frame is a retransmission of the previous packet
+        src = frame[0]
+        counter = bugonehelper.getPacketCounter(frame)
+        last = self.last_counter[src]
+        now = self._clock()
+        if last >= 0:
+            delta = (counter - last) & 0xFFFF
+            if delta == 0:
+                if frame == self.last_frame[src]:
+                    self.duplicates[src] += 1
+                    return False
+            elif delta >= 0x8000 or (counter <= self.reset_counter and delta > self.max_wrap_gap) or \
+                    (delta > 1 and now - self.last_seen[src] > self.silence):
+                self.resets[src] += 1
+            else:
+                if counter < last:
+                    self.wraps[src] += 1
+                if delta > 1:
+                    self.gaps[src] += 1
+                    self.lost[src] += delta - 1
+        self.last_counter[src] = counter
+        self.last_seen[src] = now
+        self.last_frame[src] = frame
+        self.received[src] += 1
+        return True
+
+    def loss_rate(self, nodeid):
+        total = self.received[nodeid] + self.lost[nodeid]
+        return self.lost[nodeid] / total if total else 0.0
+
+    def stats(self):
+        return dict((nodeid, {
+                    "received": self.received[nodeid],
+                    "lost": self.lost[nodeid],
+                    "loss_rate": self.loss_rate(nodeid),
+                    "gaps": self.gaps[nodeid],
+                    "duplicates": self.duplicates[nodeid],
+                    "wraps": self.wraps[nodeid],
+                    "resets": self.resets[nodeid],
+                    }) for nodeid in range(256) if self.last_counter[nodeid] >= 0)
+
+
+class LastValueCache():
+
+    # Last published value of each device, in arrays indexed by
+    # (nodeid << 8 | devid), to publish only values which changed.
+    # An integer value is suppressed when it is within threshold of the last
+    # published one (0: only identical values are suppressed, negative: never
+    # suppressed). Thresholds are in raw units, default is deadband and
+    # thresholds maps (nodeid, devid) to a specific one. The distance is
+    # computed on 16 bits, so that signed values work too. Other values
+    # (strings) are suppressed only if identical.
+    # An unchanged value is still published if the last publication of the
+    # device is at least heartbeat seconds old, so that consumers see that
+    # the node is alive (0: no heartbeat).
+
+    def __init__(self, deadband = 0, heartbeat = 300, thresholds = None, clock = time.monotonic):
+        self.heartbeat = heartbeat
+        self._clock = clock
+        self.threshold = array.array("l", [deadband] * 0x10000)
+        for ((nodeid, devid), threshold) in (thresholds or {}).items():
+            self.threshold[(nodeid << 8) | devid] = threshold
+        self.seen = bytearray(0x10000)
+        self.last_int = array.array("H", bytes(2 * 0x10000))
+        self.last_sent = array.array("d", bytes(8 * 0x10000))
+        self.last_other = {}
+        self.forwarded = array.array("Q", bytes(8 * 256))
+        self.suppressed = array.array("Q", bytes(8 * 256))
+        self.heartbeats = array.array("Q", bytes(8 * 256))
+
+    def update(self, nodeid, devid, value, isint, now = None):
+        # value is the payload given to callbacks (2 bytes, big endian, for
+        # an integer), isint tells an 'I' value from a string. Returns True
+        # if the value must be published
+        key = (nodeid << 8) | devid
+        threshold = self.threshold[key]
+        if now is None:
+            now = self._clock()
+        if isint:
+            valueInt = int.from_bytes(value, byteorder = "big")
+        if self.seen[key] and threshold >= 0:
+            if isint:
+                delta = (valueInt - self.last_int[key]) & 0xFFFF
+                changed = min(delta, 0x10000 - delta) > threshold
+            else:
+                changed = bytes(value) != self.last_other.get(key)
+            if not changed:
+                if not self.heartbeat or now - self.last_sent[key] < self.heartbeat:
+                    self.suppressed[nodeid] += 1
+                    return False
+                self.heartbeats[nodeid] += 1
+        self.seen[key] = 1
+        if isint:
+            self.last_int[key] = valueInt
+        else:
+            self.last_other[key] = bytes(value)
+        self.last_sent[key] = now
+        self.forwarded[nodeid] += 1
+        return True
+
+    def stats(self):
+        forwarded = sum(self.forwarded)
+        suppressed = sum(self.suppressed)
+        total = forwarded + suppressed
+        return {
+                "forwarded": forwarded,
+                "suppressed": suppressed,
+                "heartbeats": sum(self.heartbeats),
+                "suppression_rate": suppressed / total if total else 0.0,
+                "nodes": dict((nodeid, {
+                    "forwarded": self.forwarded[nodeid],
+                    "suppressed": self.suppressed[nodeid],
+                    "heartbeats": self.heartbeats[nodeid],
+                    }) for nodeid in range(256) if self.forwarded[nodeid] or self.suppressed[nodeid]),
+                }
+
+
+class LivenessTracker():
+
+    # Tells when a node goes silent or comes back, in arrays indexed by
+    # nodeid. Each node is expected to report every interval seconds: the
+    # interval given in intervals (nodeid -> seconds), or else the average
+    # time between its packets (until it is known, max_timeout is used). A
+    # node is declared inactive when it was not heard for missed intervals
+    # (bounded by min_timeout and max_timeout).
+    # Deadlines are kept in a hashed timer wheel of slots buckets of
+    # resolution seconds. A packet only updates the arrays: a node is not
+    # moved in the wheel when it is heard (unless its deadline gets earlier),
+    # its deadline is checked (and the node put back further in the wheel)
+    # when its bucket comes up. So seen() is O(1), and check() only looks at
+    # the buckets which elapsed.
+    # emit(nodeid, status) is called on transitions: status is True when a
+    # node is heard while it was inactive (or for the first time), False
+    # when it goes silent or announces it goes to sleep.
+
+    def __init__(self, emit, missed = 3, min_timeout = 60, max_timeout = 3600, intervals = None, resolution = 1.0,
+            slots = 4096, nodes = 256, clock = time.monotonic):
+        self.emit = emit
+        self.missed = missed
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.resolution = resolution
+        self._clock = clock
+        self.alive = bytearray(nodes)
+        self.last_seen = array.array("d", bytes(8 * nodes))
+        self.interval = array.array("d", bytes(8 * nodes))
+        self.fixed = bytearray(nodes)
+        for (nodeid, interval) in (intervals or {}).items():
+            self.interval[nodeid] = interval
+            self.fixed[nodeid] = 1
+        self.scheduled = array.array("q", [-1] * nodes)
+        self.wheel = [set() for i in range(slots)]
+        self._tick = int(clock() / resolution)
+        self.transitions = 0
+
+    def timeout(self, nodeid):
+        interval = self.interval[nodeid]
+        if not interval:
+            return self.max_timeout
+        return min(max(interval * self.missed, self.min_timeout), self.max_timeout)
+
+    def _schedule(self, nodeid, deadline):
+        tick = max(int(deadline / self.resolution) + 1, self._tick + 1)
+        self.scheduled[nodeid] = tick
+        self.wheel[tick % len(self.wheel)].add(nodeid)
+
+    def seen(self, nodeid, now = None):
+        if now is None:
+            now = self._clock()
+        if self.alive[nodeid]:
+            if not self.fixed[nodeid]:
+                # Moving average of the time between packets
+                interval = self.interval[nodeid]
+                delta = now - self.last_seen[nodeid]
+                self.interval[nodeid] = delta if not interval else interval + (delta - interval) / 8
+            self.last_seen[nodeid] = now
+            if (now + self.timeout(nodeid)) / self.resolution + 1 < self.scheduled[nodeid]:
+                # The deadline moved earlier (the node reports more often
+                # than expected): the previous wheel entry becomes stale
+                self._schedule(nodeid, now + self.timeout(nodeid))
+            return
+        self.last_seen[nodeid] = now
+        self.alive[nodeid] = 1
+        self._schedule(nodeid, now + self.timeout(nodeid))
+        self.transitions += 1
+        self.emit(nodeid, True)
+
+    def sleep(self, nodeid, now = None):
+        # The node announced it goes to sleep: it is inactive until it is
+        # heard again (its wheel entry is dropped when its bucket comes up)
+        self.last_seen[nodeid] = self._clock() if now is None else now
+        if self.alive[nodeid]:
+            self.alive[nodeid] = 0
+            self.transitions += 1
+            self.emit(nodeid, False)
+
+    def check(self, now = None):
+        # Handle the buckets which elapsed since the previous call
+        if now is None:
+            now = self._clock()
+        tick = int(now / self.resolution)
+        slots = len(self.wheel)
+        first = self._tick + 1
+        if tick - first >= slots:
+            first = tick - slots + 1
+        self._tick = tick
+        for t in range(first, tick + 1):
+            bucket = self.wheel[t % slots]
+            if not bucket:
+                continue
+            self.wheel[t % slots] = set()
+            for nodeid in bucket:
+                scheduled = self.scheduled[nodeid]
+                if not self.alive[nodeid] or scheduled % slots != t % slots:
+                    # Stale entry: the node went to sleep or was scheduled
+                    # in another bucket since
+                    continue
+                if scheduled > tick:
+                    # Due in a later round of the wheel
+                    self.wheel[t % slots].add(nodeid)
+                    continue
+                deadline = self.last_seen[nodeid] + self.timeout(nodeid)
+                if deadline > now:
+                    self._schedule(nodeid, deadline)
+                    continue
+                self.alive[nodeid] = 0
+                self.scheduled[nodeid] = -1
+                self.transitions += 1
+                self.emit(nodeid, False)
+
+    def next_check(self, now = None):
+        # Seconds until the next bucket comes up
+        if now is None:
+            now = self._clock()
+        return max(0.0, (int(now / self.resolution) + 1) * self.resolution - now)
+
+    def stats(self):
+        now = self._clock()
+        return {
+                "alive": sum(self.alive),
+                "transitions": self.transitions,
+                "nodes": dict((nodeid, {
+                    "alive": bool(self.alive[nodeid]),
+                    "last_seen_age": now - self.last_seen[nodeid],
+                    "interval": self.interval[nodeid],
+                    "timeout": self.timeout(nodeid),
+                    }) for nodeid in range(len(self.alive)) if self.last_seen[nodeid]),
+                }
+
 
 class BugOne():
 
-    def __init__(self, port, autoreconnect, baudrate, log, cb = None):
+    def __init__(self, port, autoreconnect, baudrate, log, cb = None, capture = None, metrics = None, dedup_window = 2.0,
+            deadband = None, status_cb = None, number_can_change = False, reconnect_min = 0.1, reconnect_max = 5.0,
+            liveness = None):
+        # port is a serial port, or a list of serial ports which are read
+        # concurrently. Packets heard on several ports are only processed
+        # once (see FrameDeduplicator)
+        # With autoreconnect, a port which is lost is looked for every
+        # reconnect_min seconds and opened again as soon as it is back. If it
+        # exists but cannot be opened, attempts back off up to reconnect_max
+        # seconds. With number_can_change, any unused CANDIDATE_PORTS is
+        # tried when the port itself is missing (USB adapters are often
+        # renumbered when plugged again). Without autoreconnect, the bridge
+        # stops when a port is lost.
+        # deadband is an optional LastValueCache: values it suppresses are
+        # not given to callbacks
+        # status_cb, if given, gets the status of every node (like the
+        # callbacks of register_node)
+        # liveness is an optional LivenessTracker, told about every packet
+        # (its check() must be called periodically, see the bridge)
         self.port = port
+        ports = port if isinstance(port, (list, tuple)) else [port]
+        self.sniffers = [SnifferPort(p) for p in ports]
+        self.dedup = FrameDeduplicator(dedup_window) if len(ports) > 1 else None
         self.autoreconnect = autoreconnect
+        self.number_can_change = number_can_change
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
         self.baudrate = baudrate
         self.log = log
         self.glob_cb = cb
+        self.glob_status_cb = status_cb
+        # bugonecapture.CaptureWriter, records every frame received
+        self.capture = capture
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("bridge")
+        self.metrics = metrics
+        self._process_stage = metrics.stage("process_data")
+        self._node_frames = metrics.node_counter("frames")
+        self._node_values = metrics.node_counter("values")
+        metrics.gauge("reassembly.resyncs", lambda: self._port_total("resyncs"))
+        metrics.gauge("checksum.errors", lambda: self._port_total("checksum_errors"))
+        metrics.gauge("duplicates", lambda: self._port_total("duplicates"))
+        metrics.gauge("ports", lambda: dict((p.name, p.stats()) for p in self.sniffers))
+        # Time from a lost port being found again to its first frame
+        self._reconnect_stage = metrics.stage("reconnect")
+        self.sequence = SequenceTracker()
+        metrics.gauge("sequence", self.sequence.stats)
+        self.deadband = deadband
+        self.liveness = liveness
+        if liveness:
+            metrics.gauge("liveness", liveness.stats)
+            metrics.gauge("liveness.alive", lambda: sum(liveness.alive))
+        # bugonecommand.CommandScheduler, gets every frame to match replies
+        self.commands = None
+        # Time (ns since Epoch) the frame being processed was received on the
+        # serial port (or captured, when replaying)
+        self.frame_time_ns = 0
+        if deadband:
+            metrics.gauge("deadband", deadband.stats)
+            metrics.gauge("deadband.suppressed", lambda: sum(deadband.suppressed))
         self.registered_devices = {}
         self.registered_nodes = {}
 
+        # Packet type -> handler. Handlers take the frame, source and
+        # destination, and return the node status to report
+        self.handlers = {
+                bugonehelper.PACKET_HELLO: self._on_hello,
+                bugonehelper.PACKET_PING: self._on_ping,
+                bugonehelper.PACKET_PONG: self._on_pong,
+                bugonehelper.PACKET_VALUES: self._on_values,
+                bugonehelper.PACKET_SLEEP: self._on_sleep,
+                bugonehelper.PACKET_CONFIG: self._on_config,
+                }
+        self._compile()
+
+    def _port_total(self, name):
+        return sum(p.stats()[name] for p in self.sniffers)
+
+    def _protocol_factory(self, sniffer):
+        def factory():
+            protocol = BugOneProtocol(lambda frame: self.frame_received(frame, sniffer), self.log, metrics = self.metrics)
+            protocol.sniffer = sniffer
+            sniffer.protocol = protocol
+            return protocol
+        return factory
+
     def start(self):
         self.loop = asyncio.get_event_loop()
-        coro = serial.aio.create_serial_connection(self.loop, lambda: BugOneProtocol(self.process_data,self.log), self.port, baudrate = self.baudrate)
-        self.loop.run_until_complete(coro)
+        # All ports are driven by the same event loop, each one by its own
+        # supervisor task
+        for sniffer in self.sniffers:
+            self.loop.create_task(self._supervise(sniffer))
         self.loop.run_forever()
         self.loop.close()
+        if self.capture:
+            self.capture.close()
+
+    def _find_port(self, sniffer):
+        # Device to open for sniffer, None if there is none yet
+        if os.path.exists(sniffer.name):
+            return sniffer.name
+        if not self.number_can_change:
+            return None
+        used = set(s.device for s in self.sniffers if s.connected)
+        for pattern in CANDIDATE_PORTS:
+            for device in sorted(glob.glob(pattern)):
+                if device not in used:
+                    return device
+        return None
+
+    async def _supervise(self, sniffer):
+        # Not needed to replay captures
+        import serial.aio
+        delay = self.reconnect_min
+        first = True
+        while True:
+            device = self._find_port(sniffer)
+            if device is None:
+                if not self.autoreconnect:
+                    self.log.error("Serial port %s not found", sniffer.name)
+                    self.loop.stop()
+                    return
+                (sniffer.appeared, delay) = (None, self.reconnect_min)
+                await asyncio.sleep(self.reconnect_min)
+                continue
+            if not first and sniffer.appeared is None:
+                sniffer.appeared = time.monotonic()
+            sniffer.lost = self.loop.create_future()
+            try:
+                await serial.aio.create_serial_connection(self.loop, self._protocol_factory(sniffer), device, baudrate = self.baudrate)
+            except (OSError, ValueError) as e:
+                if not self.autoreconnect:
+                    self.log.error("Cannot open serial port %s (%s)", device, e)
+                    self.loop.stop()
+                    return
+                self.log.warning("Cannot open serial port %s (%s), retrying in %.1fs", device, e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max)
+                continue
+            if not first:
+                sniffer.reconnects += 1
+            self.log.info("Serial port %s opened", device)
+            sniffer.device = device
+            delay = self.reconnect_min
+            first = False
+            exc = await sniffer.lost
+            if not self.autoreconnect:
+                self.log.error("Serial port %s lost (%s)", device, exc)
+                self.loop.stop()
+                return
+            self.log.warning("Serial port %s lost (%s), reconnecting", device, exc)
+            sniffer.appeared = None
+
+    async def replay(self, reader, realtime = False):
+        # Feed captured frames (bugonecapture.CaptureReader) to process_data
+        # Without realtime, frames are processed as fast as possible
+        self.loop = asyncio.get_event_loop()
+        count = 0
+        first = None
+        for (timestamp_ns, frame) in reader:
+            if realtime:
+                if first is None:
+                    first = (timestamp_ns, self.loop.time())
+                delay = first[1] + (timestamp_ns - first[0]) / 1e9 - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif count % 1024 == 0:
+                # Let pending callbacks (e.g. publisher flushes) run
+                await asyncio.sleep(0)
+            self.frame_time_ns = timestamp_ns
+            self._handle_frame(frame)
+            count += 1
+        return count
+
+    def send_packet(self, data):
+        # Write data (a serial frame, see bugoneframe.encode) on the first
+        # connected sniffer. Returns False if none is connected
+        for sniffer in self.sniffers:
+            if sniffer.connected and sniffer.protocol:
+                sniffer.protocol.send_data(data)
+                return True
+        return False
+
+    def frame_received(self, frame, sniffer = None):
+        if sniffer and sniffer.protocol:
+            self.frame_time_ns = sniffer.protocol.arrival_ns
+        else:
+            self.frame_time_ns = time.time_ns()
+        if sniffer:
+            sniffer.frames += 1
+            sniffer.last_frame = time.monotonic()
+            if sniffer.appeared is not None:
+                ns = int((sniffer.last_frame - sniffer.appeared) * 1e9)
+                self._reconnect_stage.record(ns)
+                sniffer.reconnect_ms = ns / 1e6
+                sniffer.appeared = None
+                self.log.info("First frame from %s %.1f ms after it was found again", sniffer.device, sniffer.reconnect_ms)
+            if self.dedup and self.dedup.is_duplicate(frame, sniffer.last_frame):
+                sniffer.duplicates += 1
+                return
+        if self.capture:
+            self.capture.append(frame, self.frame_time_ns)
+        self._handle_frame(frame)
+
+    def _handle_frame(self, frame):
+        if not self.sequence.check(frame):
+            self.log.debug("Retransmission from %s dropped", frame[0])
+            return
+        start = bugonemetrics.perf_counter_ns()
+        self.process_data(frame)
+        self._process_stage.observe(start)
+        self._node_frames[frame[0]] += 1
+        if self.commands:
+            self.commands.frame_received(frame)
 
     def register_device(self,nodeid,devid,cb_function):
         # Register to update from (nodeid,devid) device
@@ -122,63 +666,104 @@ class BugOne():
         # cb_function taks nodeid, devid and a bytearray or integer (value) as arguments
         self.registered_devices.setdefault( (nodeid,devid) , [])
         self.registered_devices[ (nodeid,devid) ].append(cb_function)
+        self._compile()
 
     def register_node(self,nodeid,cb_function_node, cb_function_dev = None):
         # Register to update from nodeid. 
         # By default, only "Node wide" updates trigger the callback (cb_function_node). 
         # This callback takes the nodeid and status (boolean) as argument
-        # If cb_function_dev is provided, it will be called for all devices of the node
+        # If cb_function_dev is provided, it will be called for all devices of the node
         self.registered_nodes.setdefault( (nodeid) , [] )
         self.registered_nodes[ (nodeid) ].append( (cb_function_node,cb_function_dev) )
+        self._compile()
+
+    def _compile(self):
+        # Flatten the registrations into tuples of callables, in the order
+        # they are called: global callback, device callbacks, node-wide
+        # device callbacks.
+        # Registration is rare, values are not: all the work is done here
+        global_cbs = (self.glob_cb,) if self.glob_cb else ()
+        glob_status = (self.glob_status_cb,) if self.glob_status_cb else ()
+        node_dev = {}
+        node_status = {}
+        for (nodeid, cbs) in self.registered_nodes.items():
+            node_dev[nodeid] = global_cbs + tuple(cb_dev for (cb_node, cb_dev) in cbs if cb_dev)
+            node_status[nodeid] = glob_status + tuple(cb_node for (cb_node, cb_dev) in cbs)
+        dev = {}
+        for ((nodeid, devid), cbs) in self.registered_devices.items():
+            dev[ (nodeid,devid) ] = global_cbs + tuple(cbs) + node_dev.get(nodeid, global_cbs)[len(global_cbs):]
+        self._glob_dispatch = global_cbs
+        self._node_dispatch = node_dev
+        self._dev_dispatch = dev
+        self._status_dispatch = node_status
+        self._glob_status_dispatch = glob_status
 
     def process_data(self,data):
-        messageType = bugonehelper.getPacketType(data)
-        srcNodeId = bugonehelper.getPacketSrc(data)
-        destNodeId = bugonehelper.getPacketDest(data)
-        counter = bugonehelper.getPacketCounter(data)
-        status = True
-        self.log.info(u"Message [%s] from %s to %s" % (counter, hex(srcNodeId), hex(destNodeId)))
-        if messageType == bugonehelper.PACKET_HELLO:
-            self.log.debug("Hello")
-        elif messageType == bugonehelper.PACKET_PING:
-            self.log.debug("Ping")
-        elif messageType == bugonehelper.PACKET_PONG:
-            self.log.debug("Pong")
-        elif messageType == bugonehelper.PACKET_VALUES:
-            values = bugonehelper.readValues(bugonehelper.getPacketData(data))
-            for (srcDevice, destDevice, value, valueInt) in values:
-                self._run_cb(srcNodeId,srcDevice,value)
-                self.log.info("(%s.%s) -> (%s.%s) = %s" % \
-                    (srcNodeId, srcDevice, destNodeId, destDevice, valueInt))
-        elif messageType == bugonehelper.PACKET_SLEEP:
-            status = False
-            self.log.debug("Sleep packet")
-        elif messageType == bugonehelper.PACKET_CONFIG:
-            configs = bugonehelper.readConfigs(bugonehelper.getPacketData(data))
-            for (srcDevice, srcType) in configs: 
-                self.log.info("Node has device %s with type %s" % (str(srcDevice),str(srcType)))
+        messageType = data[3]
+        srcNodeId = data[0]
+        destNodeId = data[1]
+        if self.log.isEnabledFor(logging.INFO):
+            self.log.info(u"Message [%s] from %#x to %#x", bugonehelper.getPacketCounter(data), srcNodeId, destNodeId)
+        handler = self.handlers.get(messageType)
+        if handler:
+            status = handler(data, srcNodeId, destNodeId)
         else:
-            self.log.debug([hex(i) for i in bugonehelper.getPacketData(data)])
+            status = True
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug([hex(i) for i in bugonehelper.getPacketData(data)])
+        if self.liveness:
+            if status:
+                self.liveness.seen(srcNodeId)
+            else:
+                self.liveness.sleep(srcNodeId)
         self._report_status(srcNodeId,status)
 
+    def _on_hello(self, data, srcNodeId, destNodeId):
+        self.log.debug("Hello")
+        return True
+
+    def _on_ping(self, data, srcNodeId, destNodeId):
+        self.log.debug("Ping")
+        return True
+
+    def _on_pong(self, data, srcNodeId, destNodeId):
+        self.log.debug("Pong")
+        return True
+
+    def _on_values(self, data, srcNodeId, destNodeId):
+        values = bugonehelper.readValues(bugonehelper.getPacketData(data), types = True)
+        self._node_values[srcNodeId] += len(values)
+        deadband = self.deadband
+        for (srcDevice, destDevice, value, valueInt, valueType) in values:
+            if deadband and not deadband.update(srcNodeId, srcDevice, value, valueType == ord('I')):
+                continue
+            self._run_cb(srcNodeId,srcDevice,value)
+            self.log.info("(%s.%s) -> (%s.%s) = %s", srcNodeId, srcDevice, destNodeId, destDevice, valueInt)
+        return True
+
+    def _on_sleep(self, data, srcNodeId, destNodeId):
+        self.log.debug("Sleep packet")
+        return False
+
+    def _on_config(self, data, srcNodeId, destNodeId):
+        configs = bugonehelper.readConfigs(bugonehelper.getPacketData(data))
+        for (srcDevice, srcType) in configs: 
+            self.log.info("Node has device %s with type %s", srcDevice, srcType)
+        return True
 
     def _report_status(self,nodeid,status):
-        if nodeid in self.registered_nodes:
-            for (cb_node, cb_dev) in self.registered_nodes[ nodeid ]:
-                cb_node(nodeid,status)
+        for cb_node in self._status_dispatch.get(nodeid, self._glob_status_dispatch):
+            cb_node(nodeid,status)
 
     def _run_cb(self,nodeid,devid,value):
-        if self.glob_cb:
-            self.glob_cb(nodeid,devid,value)
-        if (nodeid,devid) in self.registered_devices:
-            for cb in self.registered_devices[ (nodeid,devid) ]:
-                cb(nodeid,devid,value)
-        if nodeid in self.registered_nodes:
-            for (cb_node, cb_dev) in self.registered_nodes[ nodeid ]:
-                if cb_dev: 
-                    cb_dev(nodeid,devid,value)
+        cbs = self._dev_dispatch.get( (nodeid,devid) )
+        if cbs is None:
+            cbs = self._node_dispatch.get(nodeid, self._glob_dispatch)
+        for cb in cbs:
+            cb(nodeid,devid,value)
 
 if __name__ == "__main__":
+    import logging.handlers
     logger = logging.getLogger("BugOneBridge")
     logger.setLevel(logging.DEBUG)
 
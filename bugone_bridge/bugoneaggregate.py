@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Windowed aggregation of device values, for the time-series clients
+# Devices whose entry has a window (in seconds, see bugoneregistry) are not
+# written value by value: for each window, a single point holding count, min,
+# max, mean and last value is emitted.
+# Each device gets a slot in fixed-size arrays (count, sum, min, max, last,
+# window start), allocated on first use: adding a value is a few array
+# stores, and the state does not grow with the number of values.
+# Windows are aligned on multiples of their length (in seconds since Epoch),
+# so that all clients agree on them. A window is emitted when a value of a
+# later window arrives, or by tick() once it is over, so that the last
+# window of a node which stopped sending is not lost.
+
+import array
+
+
+class WindowAggregator():
+
+    # emit(entry, start, count, vmin, vmax, mean, last) is called for each
+    # closed window, start being the timestamp of the beginning of the window
+    # At most max_devices devices are aggregated: values of further devices
+    # are not taken (add returns False) and must be written as they are.
+
+    def __init__(self, emit, max_devices = 4096, grace = 1.0, check_interval = 1.0):
+        self.emit = emit
+        self.max_devices = max_devices
+        self.grace = grace
+        self.check_interval = check_interval
+        self._next_check = 0
+        self.slots = {}
+        self.entries = []
+        self.count = array.array("Q", bytes(8 * max_devices))
+        self.sum = array.array("d", bytes(8 * max_devices))
+        self.min = array.array("d", bytes(8 * max_devices))
+        self.max = array.array("d", bytes(8 * max_devices))
+        self.last = array.array("d", bytes(8 * max_devices))
+        self.start = array.array("d", bytes(8 * max_devices))
+        self.window = array.array("d", bytes(8 * max_devices))
+        self.values = 0
+        self.emitted = 0
+
+    def add(self, entry, timestamp, value):
+        window = entry.window
+        if not window:
+            return False
+        key = (entry.nodeid << 8) | entry.devid
+        slot = self.slots.get(key)
+        if slot is None:
+            if len(self.entries) >= self.max_devices:
+                return False
+            slot = len(self.entries)
+            self.slots[key] = slot
+            self.entries.append(entry)
+        # The registry may have been reloaded: always keep the latest entry
+        self.entries[slot] = entry
+
+        start = timestamp - timestamp % window
+        count = self.count[slot]
+        if count and (start != self.start[slot] or window != self.window[slot]):
+            self._close(slot)
+            count = 0
+        value = float(value)
+        if count:
+            self.sum[slot] += value
+            if value < self.min[slot]:
+                self.min[slot] = value
+            if value > self.max[slot]:
+                self.max[slot] = value
+        else:
+            self.start[slot] = start
+            self.window[slot] = window
+            self.sum[slot] = value
+            self.min[slot] = value
+            self.max[slot] = value
+        self.last[slot] = value
+        self.count[slot] = count + 1
+        self.values += 1
+        return True
+
+    def tick(self, now):
+        # To be called regularly (at least every check_interval seconds)
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.expire(now)
+
+    def expire(self, now):
+        # Emit windows which ended more than grace seconds before now (in
+        # seconds since Epoch, like value timestamps)
+        count = self.count
+        for slot in range(len(self.entries)):
+            if count[slot] and self.start[slot] + self.window[slot] + self.grace <= now:
+                self._close(slot)
+
+    def flush(self):
+        # Emit every open window (e.g. before exiting)
+        count = self.count
+        for slot in range(len(self.entries)):
+            if count[slot]:
+                self._close(slot)
+
+    def _close(self, slot):
+        count = self.count[slot]
+        start = self.start[slot]
+        if start == int(start):
+            start = int(start)
+        self.emit(self.entries[slot], start, count, self.min[slot], self.max[slot],
+                self.sum[slot] / count, self.last[slot])
+        self.count[slot] = 0
+        self.emitted += 1
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+#-*- coding: utf-8 -*-
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+Batch counterpart of bugonehelper, used to reprocess captured frames.
+Frames are the 33 bytes handed to BugOne.process_data (packet + checksum),
+stored back to back in a single buffer. Results are identical to the
+scalar getPacket*/readValues functions.
+"""
+
+import numpy
+
+import bugonehelper
+
+FRAME_SIZE = 33
+DATA_OFFSET = 6
+
+FRAME_DTYPE = numpy.dtype([
+	("src", numpy.uint8),
+	("dest", numpy.uint8),
+	("router", numpy.uint8),
+	("type", numpy.uint8),
+	("counter", numpy.uint16),
+	("checksum_ok", numpy.bool_),
+])
+
+VALUE_DTYPE = numpy.dtype([
+	("frame_idx", numpy.int64),
+	("srcDevice", numpy.uint8),
+	("destDevice", numpy.uint8),
+	("valueType", numpy.uint8),
+	("valueInt", numpy.uint16),
+])
+
+def framesView(buffer):
+	# (N, 33) uint8 view on the buffer, without copy
+	raw = numpy.frombuffer(buffer, dtype=numpy.uint8)
+	if raw.size % FRAME_SIZE:
+		raise ValueError("Buffer size (%d) is not a multiple of %d" % (raw.size, FRAME_SIZE))
+	return raw.reshape(-1, FRAME_SIZE)
+
+def decodeFrames(buffer):
+	frames = framesView(buffer)
+	out = numpy.empty(len(frames), dtype=FRAME_DTYPE)
+	out["src"] = frames[:, 0]
+	out["dest"] = frames[:, 1]
+	out["router"] = frames[:, 2]
+	out["type"] = frames[:, 3]
+	# Same byte order as readInteger
+	out["counter"] = frames[:, 4].astype(numpy.uint16) | (frames[:, 5].astype(numpy.uint16) << 8)
+	out["checksum_ok"] = numpy.bitwise_xor.reduce(frames, axis=1) == 0
+	return out
+
+def decodeValues(buffer, packetType = bugonehelper.PACKET_VALUES):
+	# Flatten the 'I'/'S' TLVs of every frame of type packetType (all frames
+	# if None) into a columnar array.
+	# TLVs are walked for all frames at once: each step reads the TLV at
+	# the current offset of each frame still being parsed.
+	frames = framesView(buffer)
+	if packetType is None:
+		idx = numpy.arange(len(frames))
+	else:
+		idx = numpy.flatnonzero(frames[:, 3] == packetType)
+	# Extra zero column: readInteger on a truncated slice only reads the
+	# bytes that exist, which is the same as reading a trailing 0
+	padded = numpy.zeros((len(idx), FRAME_SIZE + 1), dtype=numpy.intp)
+	padded[:, :FRAME_SIZE] = frames[idx]
+
+	rows = numpy.arange(len(idx))
+	offsets = numpy.full(len(idx), DATA_OFFSET, dtype=numpy.intp)
+	chunks = []
+	while True:
+		# readValues loops while more than 3 bytes are left
+		active = offsets < FRAME_SIZE - 3
+		rows = rows[active]
+		offsets = offsets[active]
+		if not len(rows):
+			break
+		current = padded[rows]
+		pick = lambda k: current[numpy.arange(len(rows)), numpy.minimum(offsets + k, FRAME_SIZE)]
+		valueType = pick(2)
+		isInt = valueType == ord('I')
+		isStr = valueType == ord('S')
+		valid = isInt | isStr
+
+		step = numpy.empty(int(valid.sum()), dtype=VALUE_DTYPE)
+		step["frame_idx"] = idx[rows[valid]]
+		step["srcDevice"] = pick(0)[valid]
+		step["destDevice"] = pick(1)[valid]
+		step["valueType"] = valueType[valid]
+		step["valueInt"] = numpy.where(isInt, pick(3) | (pick(4) << 8), 0)[valid]
+		chunks.append(step)
+
+		offsets = numpy.where(isInt, offsets + 5, offsets + 4 + pick(3))
+		rows = rows[valid]
+		offsets = offsets[valid]
+
+	if not chunks:
+		return numpy.empty(0, dtype=VALUE_DTYPE)
+	values = numpy.concatenate(chunks)
+	# Back to frame order, TLV order within a frame is kept by the stable sort
+	return values[numpy.argsort(values["frame_idx"], kind="stable")]
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Raw frame capture
+# Frames are appended to fixed size segment files, which are memory-mapped.
+# Each segment starts with a 16 bytes header (magic, record count), followed
+# by fixed size records: receive timestamp (ns since Epoch, 8 bytes) and the
+# 33 bytes frame given to process_data.
+# A sparse index (capture.idx) holds (timestamp, segment, record) for one
+# record every index_every records, to seek by time without reading segments.
+
+import bisect
+import mmap
+import os
+import struct
+
+import bugoneframe
+
+MAGIC = b"B1CAP\x00\x01\x00"
+HEADER = struct.Struct("<8sQ")
+RECORD = struct.Struct("<Q%ds" % bugoneframe.FRAME_SIZE)
+INDEX = struct.Struct("<QII")
+INDEX_FILE = "capture.idx"
+
+
+def segment_name(num):
+    return "capture-%08d.seg" % num
+
+
+def list_segments(directory):
+    nums = []
+    for name in os.listdir(directory):
+        if name.startswith("capture-") and name.endswith(".seg"):
+            nums.append(int(name[8:-4]))
+    return sorted(nums)
+
+
+class CaptureWriter():
+
+    def __init__(self, directory, segment_records = 65536, index_every = 1024):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.index_every = index_every
+        os.makedirs(directory, exist_ok = True)
+        self._index = open(os.path.join(directory, INDEX_FILE), "ab")
+        self._mm = None
+        self.written = 0
+
+        segments = list_segments(directory)
+        if segments:
+            self._open(segments[-1])
+        else:
+            self._open(0)
+
+    def _open(self, num):
+        path = os.path.join(self.directory, segment_name(num))
+        size = HEADER.size + self.segment_records * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)
+                self._mm = mmap.mmap(fd, size)
+                HEADER.pack_into(self._mm, 0, MAGIC, 0)
+            else:
+                self._mm = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        (magic, self._count) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a capture segment" % path)
+        self._num = num
+        self._capacity = (len(self._mm) - HEADER.size) // RECORD.size
+
+    def append(self, frame, timestamp_ns):
+        if self._count >= self._capacity:
+            self._mm.close()
+            self._open(self._num + 1)
+        if self._count % self.index_every == 0:
+            self._index.write(INDEX.pack(timestamp_ns, self._num, self._count))
+        RECORD.pack_into(self._mm, HEADER.size + self._count * RECORD.size, timestamp_ns, frame)
+        self._count += 1
+        # The count is updated last: a reader never sees a partial record
+        HEADER.pack_into(self._mm, 0, MAGIC, self._count)
+        self.written += 1
+
+    def flush(self):
+        self._mm.flush()
+        self._index.flush()
+
+    def close(self):
+        self.flush()
+        self._mm.close()
+        self._index.close()
+
+
+class CaptureReader():
+
+    # Iterates over (timestamp_ns, frame) records, oldest first
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.segments = list_segments(directory)
+        self.index = []
+        path = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX.size
+            self.index = [e for e in INDEX.iter_unpack(data[:usable])]
+
+    def seek(self, timestamp_ns):
+        # (segment, record) from which records at or after timestamp_ns are
+        # found
+        pos = bisect.bisect_right(self.index, (timestamp_ns, )) - 1
+        if pos < 0:
+            return (self.segments[0] if self.segments else 0, 0)
+        (ts, num, record) = self.index[pos]
+        return (num, record)
+
+    def records(self, start_ns = None):
+        (first, first_record) = (None, 0)
+        if start_ns is not None:
+            (first, first_record) = self.seek(start_ns)
+        for num in self.segments:
+            if first is not None and num < first:
+                continue
+            start = first_record if num == first else 0
+            path = os.path.join(self.directory, segment_name(num))
+            with open(path, "rb") as f:
+                # The writer may have stopped between creating a segment and
+                # sizing it: such a segment holds no record
+                if os.fstat(f.fileno()).st_size < HEADER.size:
+                    continue
+                mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                (magic, count) = HEADER.unpack_from(mm, 0)
+                if magic != MAGIC:
+                    raise ValueError("%s is not a capture segment" % path)
+                unpack_from = RECORD.unpack_from
+                for i in range(start, count):
+                    record = unpack_from(mm, HEADER.size + i * RECORD.size)
+                    if start_ns is not None and record[0] < start_ns:
+                        continue
+                    yield record
+            finally:
+                mm.close()
+
+    def __iter__(self):
+        return self.records()
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# SET/GET requests sent to the nodes through the sniffer
+# Requests for different nodes are pipelined, requests for the same node are
+# sent one at a time, so that a reply is always matched to the request in
+# flight for its node. Each request gets its own packet counter: the pending
+# table is keyed by (nodeid, counter), and a reply carrying this counter is
+# matched directly. Nodes which answer with their own counter are matched on
+# the requested device instead.
+# Packets are sent at most at rate packets per second on average, with
+# bursts of burst packets (token bucket), to share the radio airtime with
+# the nodes. A request which gets no reply within timeout seconds is sent
+# again up to retries times, then fails with asyncio.TimeoutError.
+
+import asyncio
+import collections
+import time
+
+import bugoneframe
+import bugonehelper
+
+
+class TokenBucket():
+
+    def __init__(self, rate, burst, clock = time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self.tokens = burst
+        self._last = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self):
+        # Seconds to wait before a token is available
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class Command():
+
+    __slots__ = ("packet_type", "nodeid", "devid", "value", "counter", "future", "attempts", "timer")
+
+    def __init__(self, packet_type, nodeid, devid, value, future):
+        self.packet_type = packet_type
+        self.nodeid = nodeid
+        self.devid = devid
+        self.value = value
+        self.counter = None
+        self.future = future
+        self.attempts = 0
+        self.timer = None
+
+
+class CommandScheduler():
+
+    # send(packet) writes a packet (bugonehelper.buildPacket) to the radio,
+    # and returns False if it could not be sent (no sniffer connected)
+    # frame_received(frame) must be called for every frame received, so that
+    # replies are matched.
+    # node_id is the address of the bridge on the BugOne network.
+
+    def __init__(self, send, rate = 2.0, burst = 5, timeout = 2.0, retries = 1, node_id = 0):
+        self.send = send
+        self.bucket = TokenBucket(rate, burst)
+        self.timeout = timeout
+        self.retries = retries
+        self.node_id = node_id
+        self.queues = {}
+        self.pending = {}
+        self.inflight = {}
+        self.ready = collections.deque()
+        self.counter = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        self.sent = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.retried = 0
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self.run())
+        return self._task
+
+    async def get(self, nodeid, devid):
+        # Returns the value of the device (bytes, as published)
+        return await self._request(bugonehelper.PACKET_GET, nodeid, devid, None)
+
+    async def set(self, nodeid, devid, value):
+        # value is an int, or a string (str or bytes). Returns the value
+        # reported back by the node
+        return await self._request(bugonehelper.PACKET_SET, nodeid, devid, value)
+
+    def _request(self, packet_type, nodeid, devid, value):
+        future = asyncio.get_event_loop().create_future()
+        command = Command(packet_type, nodeid, devid, value, future)
+        queue = self.queues.setdefault(nodeid, collections.deque())
+        queue.append(command)
+        if nodeid not in self.inflight and len(queue) == 1:
+            self.ready.append(nodeid)
+            self._wakeup.set()
+        return future
+
+    def queued(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def stats(self):
+        return {
+                "sent": self.sent,
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "retries": self.retried,
+                "queued": self.queued(),
+                "inflight": len(self.inflight),
+                }
+
+    async def run(self):
+        while True:
+            if not self.ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self.bucket.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            nodeid = self.ready.popleft()
+            queue = self.queues.get(nodeid)
+            if not queue or nodeid in self.inflight:
+                continue
+            command = queue.popleft()
+            if command.future.done():
+                # Cancelled by the requester
+                self._next(nodeid)
+                continue
+            self.bucket.take()
+            try:
+                self._send(command)
+            except Exception as e:
+                # A bad request fails alone, the scheduler goes on
+                self._finish(command, exception = e)
+
+    def _send(self, command):
+        self.counter = (self.counter + 1) & 0xFFFF
+        command.counter = self.counter
+        command.attempts += 1
+        try:
+            if command.packet_type == bugonehelper.PACKET_GET:
+                data = bugonehelper.writeDevices([(0, command.devid), (0xFF, 0xFF)])
+            else:
+                data = bugonehelper.writeValues([(0, command.devid, command.value), (0xFF, 0xFF, 0)])
+            packet = bugonehelper.buildPacket(command.nodeid, command.packet_type, self.node_id, command.counter, data)
+            frame = bugoneframe.encode(packet)
+        except (OverflowError, ValueError) as e:
+            # e.g. a value which does not fit in a packet
+            self._finish(command, exception = ValueError("Cannot encode command (%s)" % e))
+            return
+        self.inflight[command.nodeid] = command
+        self.pending[ (command.nodeid, command.counter) ] = command
+        try:
+            sent = self.send(frame)
+        except (OSError, ValueError) as e:
+            self._finish(command, exception = e)
+            return
+        if not sent:
+            self._finish(command, exception = ConnectionError("No sniffer connected"))
+            return
+        self.sent += 1
+        command.timer = asyncio.get_event_loop().call_later(self.timeout, self._expire, command)
+
+    def _expire(self, command):
+        if self.inflight.get(command.nodeid) is not command:
+            return
+        del self.pending[ (command.nodeid, command.counter) ]
+        if command.attempts <= self.retries and not command.future.done():
+            # Send it again before the other requests of the node
+            self.retried += 1
+            del self.inflight[command.nodeid]
+            self.queues[command.nodeid].appendleft(command)
+            self.ready.appendleft(command.nodeid)
+            self._wakeup.set()
+            return
+        self.timeouts += 1
+        self._finish(command, exception = asyncio.TimeoutError())
+
+    def _finish(self, command, value = None, exception = None):
+        if command.timer:
+            command.timer.cancel()
+        self.pending.pop( (command.nodeid, command.counter), None)
+        if self.inflight.get(command.nodeid) is command:
+            del self.inflight[command.nodeid]
+        if not command.future.done():
+            if exception is not None:
+                command.future.set_exception(exception)
+            else:
+                command.future.set_result(value)
+        self._next(command.nodeid)
+
+    def _next(self, nodeid):
+        if self.queues.get(nodeid):
+            self.ready.append(nodeid)
+            self._wakeup.set()
+        elif nodeid in self.queues and nodeid not in self.inflight:
+            del self.queues[nodeid]
+
+    def frame_received(self, frame):
+        src = frame[0]
+        if src not in self.inflight or frame[3] != bugonehelper.PACKET_VALUES:
+            return
+        if frame[1] != self.node_id and frame[1] != 0xFF:
+            return
+        command = self.pending.get( (src, bugonehelper.getPacketCounter(frame)) )
+        values = bugonehelper.readValues(bugonehelper.getPacketData(frame))
+        if command is None:
+            command = self.inflight[src]
+            values = [v for v in values if v[0] == command.devid]
+            if not values:
+                return
+        else:
+            values = [v for v in values if v[0] == command.devid] or values
+        if not values:
+            return
+        self.completed += 1
+        self._finish(command, values[0][2])
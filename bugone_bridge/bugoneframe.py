@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+import time
+
+import bugonemetrics
+
+# On the serial line, the sniffer sends a length byte (always 32 for BugOne
+# packets), the 32 bytes of the packet and a XOR checksum byte.
+# The frame handed to process_data is the packet followed by its checksum.
+PACKET_LENGTH = 32
+FRAME_SIZE = PACKET_LENGTH + 1
+WIRE_SIZE = FRAME_SIZE + 1
+
+_MASK_256 = (1 << 256) - 1
+_FOLDS = ((128, (1 << 128) - 1), (64, (1 << 64) - 1), (32, (1 << 32) - 1),
+          (16, 0xFFFF), (8, 0xFF))
+
+
+def checksum_ok(frame):
+    # XOR of the 32 bytes and the checksum must be 0. Instead of looping on
+    # each byte, fold the frame as a big integer: the 33rd byte is xored on
+    # the first one, then the 256 bits are folded in halves down to one byte.
+    x = int.from_bytes(frame, "little")
+    x = (x ^ (x >> 256)) & _MASK_256
+    for (shift, mask) in _FOLDS:
+        x = (x ^ (x >> shift)) & mask
+    return x == 0
+
+
+def encode(packet):
+    # Serial framing of a packet to send: length byte, packet padded to
+    # PACKET_LENGTH bytes, XOR checksum
+    if len(packet) > PACKET_LENGTH:
+        raise ValueError("Packet too long (%d bytes)" % len(packet))
+    packet = bytes(packet) + bytes(PACKET_LENGTH - len(packet))
+    checksum = 0
+    for b in packet:
+        checksum ^= b
+    return bytes((PACKET_LENGTH,)) + packet + bytes((checksum,))
+
+
+class FrameReassembler():
+
+    # Rebuilds frames from the serial byte stream.
+    # Incoming bytes are copied once into a preallocated buffer. A frame is
+    # accepted only when a length byte is followed by a packet with a valid
+    # checksum. Otherwise, we slide one byte and look for the next candidate,
+    # which resynchronizes the stream after any corruption.
+    # If a partial frame waits for more than timeout seconds between two
+    # bytes, it is discarded.
+    # Three stages are recorded: serial_read (copy of the incoming bytes),
+    # reassembly (search of frame boundaries, checksums included) and
+    # checksum. Frames are handed to cb_frame once a scan is over, so that
+    # the processing of frames is not counted in these stages.
+
+    def __init__(self, cb_frame, timeout = 0.05, capacity = 4096, clock = time.monotonic, metrics = None):
+        self._cb_frame = cb_frame
+        self.timeout = timeout
+        self._clock = clock
+        self._buf = bytearray(max(capacity, 2 * WIRE_SIZE))
+        self._view = memoryview(self._buf)
+        self._fill = 0
+        self._last = 0
+
+        self.received = 0
+        self.errors = 0
+        self.discarded = 0
+        self.timeouts = 0
+        self.recovered = 0
+        self.bad_checksums = 0
+        self._resyncing = False
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("reassembler")
+        self._read_stage = metrics.stage("serial_read")
+        self._reassembly_stage = metrics.stage("reassembly")
+        self._checksum_stage = metrics.stage("checksum")
+
+    def reset(self):
+        self._fill = 0
+        self._resyncing = False
+
+    def feed(self, data, now = None):
+        if now is None:
+            now = self._clock()
+        if self._fill and self.timeout and now - self._last > self.timeout:
+            # Stale partial frame: the sender restarted or bytes were lost
+            self.timeouts += 1
+            self.discarded += self._fill
+            self._fill = 0
+        self._last = now
+
+        data = memoryview(data)
+        room = len(self._buf) - WIRE_SIZE
+        while len(data) > 0:
+            # Never keep more than a partial frame, so there is always room
+            # for at least one chunk of (capacity - WIRE_SIZE) bytes
+            chunk = min(len(data), room)
+            start = bugonemetrics.perf_counter_ns()
+            self._view[self._fill:self._fill + chunk] = data[:chunk]
+            self._read_stage.observe(start)
+            self._fill += chunk
+            data = data[chunk:]
+            self._scan()
+
+    def _scan(self):
+        perf_counter_ns = bugonemetrics.perf_counter_ns
+        start = perf_counter_ns()
+        checksum_stage = self._checksum_stage
+        buf = self._buf
+        view = self._view
+        fill = self._fill
+        pos = 0
+        frames = []
+        while fill - pos >= WIRE_SIZE:
+            if buf[pos] == PACKET_LENGTH:
+                frame = view[pos + 1:pos + WIRE_SIZE]
+                checked = perf_counter_ns()
+                ok = checksum_ok(frame)
+                checksum_stage.observe(checked)
+                if ok:
+                    self.received += 1
+                    if self._resyncing:
+                        self.recovered += 1
+                        self._resyncing = False
+                    frames.append(bytes(frame))
+                    pos += WIRE_SIZE
+                    continue
+                checksum_stage.errors += 1
+                self.bad_checksums += 1
+            # Not a frame boundary: drop one byte and try again
+            if not self._resyncing:
+                self.errors += 1
+                self._reassembly_stage.errors += 1
+                self._resyncing = True
+            self.discarded += 1
+            pos += 1
+
+        if pos:
+            remaining = fill - pos
+            view[0:remaining] = view[pos:fill]
+            self._fill = remaining
+        self._reassembly_stage.observe(start)
+        for frame in frames:
+            self._cb_frame(frame)
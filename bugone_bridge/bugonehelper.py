@@ -66,7 +66,8 @@ def getPacketData(message):
 
 ### Parse data ###
 
-def readValues(data):
+# With types, the TLV type (ord('I') or ord('S')) is added to each value
+def readValues(data, types = False):
 	values = []
 	while len(data) > 3:
 		srcDevice = data[0]
@@ -84,7 +85,10 @@ def readValues(data):
 			data = data[4+count:]
 		else:
 			break
-		values.append((srcDevice, destDevice, value, valueInt))
+		if types:
+			values.append((srcDevice, destDevice, value, valueInt, valueType))
+		else:
+			values.append((srcDevice, destDevice, value, valueInt))
 	return values
 
 def readConfigs(data):
@@ -100,22 +104,23 @@ def readConfigs(data):
     return configs
 
 def writeValues(values):
-	data = ""
+	# Integers are sent as 'I' values, strings (str or bytes) as 'S' values
+	data = bytearray()
 	for (srcDeviceId, destDeviceId, value) in values:
-		data += chr(srcDeviceId)
-		data += chr(destDeviceId)
+		data += bytes((srcDeviceId, destDeviceId))
 		if type(value) is int:
-			data += 'I' + writeInteger(value)
-		elif type(value) is str:
-			data += 'S' + chr(len(value)) + value
-	return data
+			data += b'I' + writeInteger(value)
+		elif isinstance(value, (str, bytes, bytearray)):
+			if type(value) is str:
+				value = value.encode("utf-8")
+			data += b'S' + bytes((len(value),)) + value
+	return bytes(data)
 
 def writeDevices(devices):
-	data = ""
+	data = bytearray()
 	for (srcDeviceId, destDeviceId) in devices:
-		data += chr(srcDeviceId)
-		data += chr(destDeviceId)
-	return data
+		data += bytes((srcDeviceId, destDeviceId))
+	return bytes(data)
 
 ### Send packet ###
 
@@ -132,6 +137,8 @@ def setValue(destNodeId, srcDeviceId, destDeviceId, value, sniffer):
 	data = writeValues([(srcDeviceId, destDeviceId, value),(0xFF,0xFF,0)])
 	sniffer.send(buildPacket(destNodeId, PACKET_SET, data=data))
 
+# Blocks until the sniffer gets a message: the bridge uses bugonecommand
+# instead
 def getValue(destNodeId, srcDeviceId, destDeviceId, sniffer):
 	data = writeDevices([(srcDeviceId, destDeviceId),(0xFF,0xFF)])
 	sniffer.send(buildPacket(destNodeId, PACKET_GET, data=data))
@@ -146,10 +153,10 @@ def getValue(destNodeId, srcDeviceId, destDeviceId, sniffer):
 # return packet formatted according bugOne protocol (do not send)
 # packetType can be: 1 Hello, 2 Ping, 3 Pong, 4 Get, 5 Set, 6 Values
 def buildPacket(destNodeId, packetType, srcNodeId = 0, lastCounter = 0, data = None):
-	message  = chr(srcNodeId)   # Src
-	message += chr(destNodeId)  # Dest
-	message += chr(0)           # Router
-	message += chr(packetType)  # Type
+	message  = bytes((srcNodeId,   # Src
+			destNodeId,            # Dest
+			0,                     # Router
+			packetType))           # Type
 	message += writeInteger(lastCounter) # Counter
 	if data:
 		message += data
@@ -164,5 +171,5 @@ def readInteger(bytes, bigEndian = True):
 	return res
 
 def writeInteger(value):
-	return chr(value & 0x00FF) + chr((value & 0xFF00) >> 8)
+	return bytes((value & 0x00FF, (value & 0xFF00) >> 8))
 
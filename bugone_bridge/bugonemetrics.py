@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Pipeline instrumentation, shared by the bridge and the clients
+# A stage counts events, errors, and keeps a latency histogram with power of
+# two buckets (in ns): recording is an integer bit_length and two additions.
+# Per-node counters are arrays indexed by nodeid.
+# Gauges are callables evaluated when a snapshot is taken, for values that
+# are already counted elsewhere (e.g. reassembler counters).
+
+import array
+import threading
+import time
+
+perf_counter_ns = time.perf_counter_ns
+
+
+class Stage():
+
+    __slots__ = ("count", "errors", "total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0
+        self.buckets = [0] * 64
+
+    def observe(self, start_ns):
+        # start_ns is a perf_counter_ns() value taken when the stage began
+        self.record(perf_counter_ns() - start_ns)
+
+    def record(self, ns):
+        # Duration measured elsewhere (e.g. with wall clock timestamps)
+        if ns < 0:
+            ns = 0
+        self.count += 1
+        self.total += ns
+        self.buckets[min(ns.bit_length(), 63)] += 1
+
+    def percentile(self, p):
+        # Upper bound (ns) of the bucket holding the p-th percentile
+        if not self.count:
+            return 0
+        rank = self.count * p / 100.0
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return 1 << i
+        return 1 << 63
+
+    def snapshot(self):
+        return {
+                "count": self.count,
+                "errors": self.errors,
+                "mean_us": (self.total / self.count / 1000.0) if self.count else 0,
+                "p50_us": self.percentile(50) / 1000.0,
+                "p99_us": self.percentile(99) / 1000.0,
+                }
+
+
+class Metrics():
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.stages = {}
+        self.nodes = {}
+        self.gauges = {}
+
+    def stage(self, name):
+        return self.stages.setdefault(name, Stage())
+
+    def node_counter(self, name):
+        return self.nodes.setdefault(name, array.array("Q", bytes(8 * 256)))
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def snapshot(self):
+        nodes = {}
+        for (name, counts) in self.nodes.items():
+            nodes[name] = dict((nodeid, n) for (nodeid, n) in enumerate(counts) if n)
+        gauges = {}
+        for (name, fn) in self.gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                gauges[name] = None
+        return {
+                "name": self.name,
+                "uptime": time.time() - self.started,
+                "stages": dict((name, s.snapshot()) for (name, s) in self.stages.items()),
+                "gauges": gauges,
+                "nodes": nodes,
+                }
+
+    def serve_http(self, address, port):
+        # Serve snapshots as JSON on http://address:port/ from a background
+        # thread
+        import http.server
+        import json
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot(), indent = 1).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, int(port)), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# BugOne network description (bugnet.yaml), shared by the clients
+# The description is compiled into a table indexed by (nodeid << 8 | devid),
+# so resolving a device is a single list access.
+# Parsing and validating the YAML file is the slow part of a client start:
+# the validated description is cached (see load_cached_db), and yaml and
+# voluptuous are only imported when the cache cannot be used.
+
+import hashlib
+import marshal
+import os
+import tempfile
+import time
+
+def format_float_value(v):
+    return float(v)/10
+
+def format_mil_value(v):
+    return float(v)/1000
+
+def format_bool_value(v):
+    return False if v == 0 else True
+
+def format_raw_value(v):
+    return v
+
+datatype = {
+        "temperature": format_float_value,
+        "humidity": format_float_value,
+        "voltage": format_mil_value,
+        "switch": format_bool_value
+        }
+
+# Bump when the cached data changes
+CACHE_VERSION = 1
+
+
+def validate_db(db):
+    import voluptuous
+    device = {
+            voluptuous.Optional("display"): str,
+            voluptuous.Required("type"): str,
+            voluptuous.Required("nodeid"): int,
+            voluptuous.Required("devid"): int,
+            voluptuous.Optional("format"): int,
+            voluptuous.Optional("window"): voluptuous.Any(int, float)
+    }
+    node = {
+            voluptuous.Required("location"): str,
+            voluptuous.Optional("display"): str,
+            voluptuous.Required("nodeid"): int,
+            voluptuous.Required("address"): str
+    }
+    schema = voluptuous.Schema({
+        voluptuous.Optional("name"): str,
+        voluptuous.Required("nodes"): [node],
+        voluptuous.Required("devices"): [device],
+        # Aggregation window (in seconds) for each device type
+        voluptuous.Optional("aggregation"): {str: voluptuous.Any(int, float)}
+    })
+    try:
+        schema(db)
+    except voluptuous.MultipleInvalid as e:
+        print(e)
+        return False
+    return True
+
+
+def parse_db(data):
+    # YAML errors are raised as ValueError
+    import yaml
+    try:
+        return yaml.safe_load(data)
+    except yaml.YAMLError as e:
+        raise ValueError("Invalid YAML (%s)" % e)
+
+
+def cache_path(yaml_path):
+    # Next to the description if its directory is writable, in the user
+    # cache directory otherwise
+    (directory, name) = os.path.split(os.path.abspath(yaml_path))
+    if os.access(directory, os.W_OK):
+        return os.path.join(directory, "." + name + ".cache")
+    cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "bugone")
+    key = hashlib.sha1(os.path.abspath(yaml_path).encode("utf-8")).hexdigest()
+    return os.path.join(cache_dir, key + ".cache")
+
+
+def load_cached_db(yaml_path):
+    # Validated description of yaml_path, from the cache when possible.
+    # The cache holds the mtime, size and SHA-256 of the file it was built
+    # from: if mtime and size match, it is used at once. Otherwise, the file
+    # is hashed, and only parsed and validated again if its content changed.
+    # Raises OSError, or ValueError if the description is invalid.
+    yaml_path = os.path.expanduser(yaml_path)
+    st = os.stat(yaml_path)
+    path = cache_path(yaml_path)
+    cached = None
+    try:
+        with open(path, "rb") as f:
+            cached = marshal.load(f)
+        (version, mtime, size, digest, db) = cached
+        if version != CACHE_VERSION:
+            cached = None
+        elif mtime == st.st_mtime_ns and size == st.st_size:
+            return db
+    except (OSError, EOFError, ValueError, TypeError):
+        cached = None
+    with open(yaml_path, "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if cached and cached[3] == digest:
+        db = cached[4]
+    else:
+        db = parse_db(data)
+        if not validate_db(db):
+            raise ValueError("Invalid network description (%s)" % yaml_path)
+    tmp = None
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        # Written to a file of its own and renamed, so that a reader never
+        # sees a partial cache, even when several clients start together
+        (fd, tmp) = tempfile.mkstemp(dir = os.path.dirname(path), prefix = os.path.basename(path) + ".")
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump((CACHE_VERSION, st.st_mtime_ns, st.st_size, digest, db), f)
+        os.replace(tmp, path)
+    except (OSError, ValueError):
+        # No cache, next start parses the file again
+        if tmp is not None:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+    return db
+
+
+class DeviceEntry():
+
+    # Everything a client needs to handle a value from a device
+    # sink holds data precomputed by the client (see DeviceRegistry)
+    # window is the aggregation window in seconds (0: every value is written,
+    # see bugoneaggregate)
+
+    __slots__ = ("nodeid", "devid", "display", "address", "devicename", "convert", "path", "tags", "window", "sink")
+
+    def __init__(self, nodeid, devid, display, address, devicename, convert, window = 0):
+        self.nodeid = nodeid
+        self.devid = devid
+        self.display = display
+        self.address = address
+        self.devicename = devicename
+        self.convert = convert
+        self.path = "bugone." + address + "." + devicename
+        self.tags = (("location", address), ("nodeid", nodeid), ("devid", devid))
+        self.window = window
+        self.sink = None
+
+
+class DeviceRegistry():
+
+    # Compiled view of bugnet.yaml
+    # lookup() never scans the description. Devices which are not described
+    # get a default entry (raw value, "node<id>"/"dev<id>" names), created on
+    # first use.
+    # The file is checked for changes at most every check_interval seconds
+    # (see maybe_reload). A new table is built aside and swapped in a single
+    # assignment: if the new file is invalid, the previous table is kept.
+    # compile_hook(entry), if given, is called for each entry and its result
+    # stored in entry.sink (e.g. a precomputed line protocol prefix).
+
+    def __init__(self, yaml_path, compile_hook = None, check_interval = 5.0):
+        self.yaml_path = os.path.expanduser(yaml_path)
+        self.compile_hook = compile_hook
+        self.check_interval = check_interval
+        self._mtime = None
+        self._next_check = 0
+        self.desc = None
+        self.table = None
+        self.addresses = None
+        self.windows = None
+        self.reload()
+
+    def reload(self):
+        mtime = os.stat(self.yaml_path).st_mtime_ns
+        db = load_cached_db(self.yaml_path)
+        (table, addresses, windows) = self._compile(db)
+        # Readers only ever see the old or the new table
+        (self.desc, self.table, self.addresses, self.windows) = (db, table, addresses, windows)
+        self._mtime = mtime
+        self._next_check = time.monotonic() + self.check_interval
+
+    def maybe_reload(self):
+        # Returns True if the description was reloaded
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        try:
+            if os.stat(self.yaml_path).st_mtime_ns == self._mtime:
+                return False
+            self.reload()
+        except (OSError, ValueError) as e:
+            print("Cannot reload network description, keeping the previous one (%s)" % e)
+            return False
+        print("Network description reloaded (%s)" % self.yaml_path)
+        return True
+
+    def _compile(self, db):
+        addresses = {}
+        for n in db["nodes"]:
+            addresses.setdefault(n["nodeid"], n["address"])
+        windows = db.get("aggregation", {})
+        table = [None] * 0x10000
+        for d in db["devices"]:
+            key = (d["nodeid"] << 8) | d["devid"]
+            if table[key] is not None:
+                continue
+            address = addresses.get(d["nodeid"], "node" + str(d["nodeid"]))
+            convert = datatype.get(d["type"], format_raw_value)
+            window = d.get("window", windows.get(d["type"], 0))
+            entry = DeviceEntry(d["nodeid"], d["devid"], d.get("display", d["type"]), address, d["type"], convert, window)
+            if self.compile_hook:
+                entry.sink = self.compile_hook(entry)
+            table[key] = entry
+        return (table, addresses, windows)
+
+    def lookup(self, nodeid, devid):
+        table = self.table
+        entry = table[(nodeid << 8) | devid]
+        if entry is None:
+            entry = DeviceEntry(nodeid, devid, "Device " + str(nodeid) + "," + str(devid),
+                    self.addresses.get(nodeid, "node" + str(nodeid)), "dev" + str(devid), format_raw_value,
+                    self.windows.get("dev" + str(devid), 0))
+            if self.compile_hook:
+                entry.sink = self.compile_hook(entry)
+            table[(nodeid << 8) | devid] = entry
+        return entry
+
+    def devices(self):
+        return [(d["nodeid"], d["devid"]) for d in self.desc["devices"]]
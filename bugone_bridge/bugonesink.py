@@ -0,0 +1,735 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Writers for the time-series databases, shared by the clients, and the
+# decoding of the messages they receive (MessageReader)
+# CarbonSender writes to carbon (pickle protocol), LineProtocolWriter to
+# InfluxDB (line protocol over HTTP)
+#
+# Sinks of the unified client (bugone_client): the client decodes each
+# message once into a Record, and gives it to every sink. A sink queues
+# records and handles them in its own thread, so that a slow sink does not
+# delay the others. Sinks are built from their section of the client
+# configuration file (see SINKS).
+# pickle and http.client are only imported by the writers which use them, so
+# that a client does not pay for the protocols it does not speak.
+
+import collections
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+
+import bugonemetrics
+import bugonespool
+import bugonewire
+
+
+class CarbonSender():
+
+    # Long-lived connection to the carbon pickle receiver.
+    # Datapoints are accumulated and sent as a single pickled list when
+    # batch_size points are waiting, or flush_interval seconds after the
+    # first one was added. If carbon cannot be reached, points are kept (up
+    # to max_pending, oldest are dropped first) and the connection is retried
+    # with an exponential backoff.
+    # With a spool (bugonespool.Spool), batches which cannot be sent are
+    # written to disk instead, and sent again by bulks of spool_bulk bytes
+    # once carbon is back. While the spool is not empty, new batches go to
+    # the spool too, so that carbon receives points in order.
+
+    def __init__(self, address, port, batch_size = 500, flush_interval = 1.0,
+            max_pending = 50000, backoff_min = 0.5, backoff_max = 30.0, timeout = 5.0, metrics = None,
+            spool = None, spool_bulk = 1 << 20):
+        self.address = (address, int(port))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.spool = spool
+        self.spool_bulk = spool_bulk
+
+        self.points = []
+        self.sock = None
+        self._first = None
+        self._backoff = backoff_min
+        self._next_attempt = 0
+        self.sent = 0
+        self.dropped = 0
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("graphite")
+        self._write_stage = metrics.stage("sink_write")
+        metrics.gauge("carbon.pending", lambda: len(self.points))
+        metrics.gauge("carbon.dropped", lambda: self.dropped)
+        metrics.gauge("carbon.sent", lambda: self.sent)
+        if spool is not None:
+            spool.register_metrics(metrics, "carbon.spool")
+
+    def add(self, path, timestamp, value):
+        if not self.points:
+            self._first = time.monotonic()
+        self.points.append( (path, (timestamp, value)) )
+        if len(self.points) > self.max_pending:
+            drop = len(self.points) - self.max_pending
+            del self.points[:drop]
+            self.dropped += drop
+        if len(self.points) >= self.batch_size:
+            self.flush()
+
+    def next_flush(self):
+        # Seconds before the pending points must be flushed (or the spool
+        # drained), None if nothing is pending
+        due = None
+        if self.points:
+            due = self._first + self.flush_interval
+        if self.spool is not None and not self.spool.empty():
+            due = time.monotonic() if due is None else min(due, time.monotonic())
+        if due is None:
+            return None
+        if self.sock is None:
+            due = max(due, self._next_attempt)
+        return max(0, due - time.monotonic())
+
+    def tick(self):
+        if self.points and time.monotonic() - self._first >= self.flush_interval:
+            self.flush()
+        elif self.spool is not None:
+            self.drain()
+
+    def flush(self):
+        import pickle
+        while self.points:
+            batch = self.points[:self.batch_size]
+            payload = pickle.dumps(batch, protocol=2)
+            if self.spool is not None and not self.spool.empty():
+                # Older points wait in the spool
+                self.spool.append(payload, len(batch))
+            elif self._connect() and self._send(struct.pack("!L", len(payload)) + payload):
+                self.sent += len(batch)
+            elif self.spool is not None:
+                self.spool.append(payload, len(batch))
+            else:
+                return False
+            del self.points[:len(batch)]
+        self._first = None
+        if self.spool is not None:
+            self.drain()
+        return True
+
+    def drain(self):
+        # Send a bulk of spooled batches. Returns True if the spool is empty
+        if self.spool.empty():
+            return True
+        if not self._connect():
+            return False
+        (records, position) = self.spool.read(self.spool_bulk)
+        if not records:
+            # Nothing to send
+            return True
+        data = b"".join(struct.pack("!L", len(payload)) + payload for (payload, points) in records)
+        points = sum(points for (payload, points) in records)
+        if not self._send(data):
+            return False
+        self.spool.commit(position, points)
+        self.sent += points
+        return self.spool.empty()
+
+    def _send(self, data):
+        start = bugonemetrics.perf_counter_ns()
+        try:
+            self.sock.sendall(data)
+            self._write_stage.observe(start)
+        except OSError as e:
+            self._write_stage.errors += 1
+            print("Error while sending to carbon (%s), reconnecting" % e)
+            self._disconnect()
+            return False
+        return True
+
+    def close(self):
+        self.flush()
+        self._disconnect()
+        if self.spool is not None:
+            self.spool.close()
+
+    def _connect(self):
+        if self.sock is not None:
+            return True
+        now = time.monotonic()
+        if now < self._next_attempt:
+            return False
+        try:
+            self.sock = socket.create_connection(self.address, self.timeout)
+        except OSError as e:
+            print("Cannot connect to carbon at %s:%s (%s), retrying in %.1fs" % \
+                (self.address[0], self.address[1], e, self._backoff))
+            self._next_attempt = now + self._backoff
+            self._backoff = min(self._backoff * 2, self.backoff_max)
+            return False
+        self._backoff = self.backoff_min
+        return True
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._next_attempt = time.monotonic() + self._backoff
+        self._backoff = min(self._backoff * 2, self.backoff_max)
+
+
+def escape_tag(s):
+    return str(s).replace(",", "\\,").replace("=", "\\=").replace(" ", "\\ ")
+
+def format_field(v):
+    if isinstance(v, bool):
+        return "true" if v else "false"
+    if isinstance(v, int):
+        return "%di" % v
+    return repr(float(v))
+
+def line_prefix(measurement, tags):
+    # "measurement,tag=value,... value=" part of a line, computed once per
+    # device
+    prefix = str(measurement).replace(",", "\\,").replace(" ", "\\ ")
+    for (k, v) in tags:
+        prefix += "," + escape_tag(k) + "=" + escape_tag(v)
+    return prefix + " value="
+
+
+class LineProtocolWriter():
+
+    # Writes points to InfluxDB using the line protocol, from a background
+    # thread, on a single kept-alive HTTP connection.
+    # Points are sent by batches of batch_size, or when the oldest waiting
+    # point is flush_interval seconds old. At most queue_size points wait;
+    # when the queue is full, policy decides what happens:
+    # - block: write() waits for room (back pressure on the zMQ loop)
+    # - drop_oldest: the oldest waiting point is discarded
+    # - drop_newest: the new point is discarded
+    # With a spool (bugonespool.Spool), batches which cannot be written are
+    # stored on disk instead of being retried, and sent again by bulks of
+    # spool_bulk bytes once InfluxDB is back.
+
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, address, port, database, user = None, password = None, ssl = False,
+            batch_size = 5000, flush_interval = 1.0, queue_size = 100000, policy = "block",
+            precision = "s", timeout = 10.0, metrics = None, spool = None, spool_bulk = 4 << 20):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown queue full policy (%s)" % policy)
+        self.address = address
+        self.port = int(port)
+        self.ssl = ssl
+        self.timeout = timeout
+        params = {"db": database, "precision": precision}
+        if user:
+            params["u"] = user
+            params["p"] = password
+        self.url = "/write?" + urllib.parse.urlencode(params)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.policy = policy
+        self.spool = spool
+        self.spool_bulk = spool_bulk
+
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.conn = None
+        self.running = True
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._oldest = None
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("influxdb")
+        self._write_stage = metrics.stage("sink_write")
+        metrics.gauge("influx.queued", lambda: len(self.queue))
+        metrics.gauge("influx.dropped", lambda: self.dropped)
+        metrics.gauge("influx.written", lambda: self.written)
+        if spool is not None:
+            spool.register_metrics(metrics, "influx.spool")
+        self.thread = threading.Thread(target=self._run, name="influx-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, prefix, value, timestamp, fields = ""):
+        # fields: more ",key=value" fields of the point, already formatted
+        line = prefix + format_field(value) + fields + " " + str(timestamp)
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return
+                elif self.policy == "drop_oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.queue) >= self.queue_size and self.running:
+                        self.cond.wait()
+            self.queue.append(line)
+            if len(self.queue) == 1:
+                # Start the flush_interval timer of the writer thread
+                self._oldest = time.monotonic()
+                self.cond.notify_all()
+            elif len(self.queue) >= self.batch_size:
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+    def _run(self):
+        import http.client
+        backoff = 0.5
+        retry_at = 0
+        batch = None
+        while True:
+            with self.cond:
+                while self.running and len(self.queue) < self.batch_size:
+                    now = time.monotonic()
+                    draining = self.spool is not None and not self.spool.empty()
+                    if draining and now >= retry_at:
+                        break
+                    if self.queue:
+                        wait = self._oldest + self.flush_interval - now
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    if draining:
+                        wait = retry_at - now if wait is None else min(wait, retry_at - now)
+                    self.cond.wait(wait)
+                if not self.queue and not self.running:
+                    break
+                count = min(len(self.queue), self.batch_size)
+                batch = [self.queue.popleft() for i in range(count)]
+                self._oldest = time.monotonic() if self.queue else None
+                self.cond.notify_all()
+            if self.spool is not None:
+                # Nothing is retried in memory: what cannot be sent goes to
+                # the spool, which is sent again oldest first
+                failed = False
+                available = time.monotonic() >= retry_at
+                if batch:
+                    body = "\n".join(batch).encode("utf-8")
+                    if not available or not self.spool.empty():
+                        self.spool.append(body, len(batch))
+                    elif not self._send(body, len(batch)):
+                        self.spool.append(body, len(batch))
+                        failed = True
+                    batch = None
+                if available and not failed and not self.spool.empty():
+                    (records, position) = self.spool.read(self.spool_bulk)
+                    points = sum(points for (payload, points) in records)
+                    # No record: nothing to send (see Spool.read)
+                    if records:
+                        if self._send(b"\n".join(payload for (payload, points) in records), points):
+                            self.spool.commit(position, points)
+                        else:
+                            failed = True
+                if failed:
+                    print("InfluxDB unavailable, spooling points, retrying in %.1fs" % backoff)
+                    retry_at = time.monotonic() + backoff
+                    backoff = min(backoff * 2, 30.0)
+                elif available:
+                    backoff = 0.5
+                continue
+            while batch:
+                start = bugonemetrics.perf_counter_ns()
+                try:
+                    self._post("\n".join(batch).encode("utf-8"))
+                    self._write_stage.observe(start)
+                    self.written += len(batch)
+                    batch = None
+                    backoff = 0.5
+                except (OSError, http.client.HTTPException) as e:
+                    self.errors += 1
+                    self._write_stage.errors += 1
+                    print("Error while writing to InfluxDB (%s), retrying in %.1fs" % (e, backoff))
+                    if not self.running:
+                        break
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 30.0)
+        if self.spool is not None:
+            self.spool.close()
+
+    def _send(self, body, points):
+        # Returns False if the points must be sent again later
+        import http.client
+        start = bugonemetrics.perf_counter_ns()
+        try:
+            self._post(body)
+        except (OSError, http.client.HTTPException) as e:
+            self.errors += 1
+            self._write_stage.errors += 1
+            print("Error while writing to InfluxDB (%s)" % e)
+            return False
+        self._write_stage.observe(start)
+        self.written += points
+        return True
+
+    def _post(self, body):
+        import http.client
+        if self.conn is None:
+            if self.ssl:
+                self.conn = http.client.HTTPSConnection(self.address, self.port, timeout = self.timeout)
+            else:
+                self.conn = http.client.HTTPConnection(self.address, self.port, timeout = self.timeout)
+        try:
+            self.conn.request("POST", self.url, body, {"Content-Type": "text/plain; charset=utf-8"})
+            response = self.conn.getresponse()
+            content = response.read()
+        except:
+            self.conn.close()
+            self.conn = None
+            raise
+        if response.status >= 300:
+            # A rejected batch (e.g. parse error) is not retried
+            if response.status >= 500:
+                raise http.client.HTTPException("HTTP %d: %s" % (response.status, content))
+            self.errors += 1
+            print("InfluxDB rejected batch (HTTP %d): %s" % (response.status, content))
+
+
+class MessageReader():
+
+    # First step of every client: decodes a message from the bridge,
+    # resolves its device in the registry (bugoneregistry.DeviceRegistry)
+    # and converts its value. Records the decode stage, the pipeline stage
+    # (time from the frame arrival on the bridge, topic format only: the
+    # legacy one has no sub-second timestamps), the registry stage and the
+    # values received per node.
+    # A message which cannot be decoded (e.g. from a newer bridge) is
+    # reported once, then counted in the decode stage errors.
+
+    def __init__(self, registry, metrics):
+        self.registry = registry
+        self._decode_stage = metrics.stage("decode")
+        self._pipeline_stage = metrics.stage("pipeline")
+        self._registry_stage = metrics.stage("registry")
+        self._node_values = metrics.node_counter("values")
+
+    def read(self, message):
+        # Returns (msg, entry, value) for a values or config message, None
+        # otherwise. msg is the bugonewire.Message
+        start = bugonemetrics.perf_counter_ns()
+        try:
+            msg = bugonewire.decode_message(message)
+        except ValueError as e:
+            self._decode_stage.errors += 1
+            if self._decode_stage.errors == 1:
+                print("Dropping message (%s)" % e)
+            return None
+        self._decode_stage.observe(start)
+        if msg.ingest_ns is not None:
+            self._pipeline_stage.record(time.time_ns() - msg.timestamp_ns)
+        if msg.msgtype >= bugonewire.MSG_STATUS:
+            return None
+        start = bugonemetrics.perf_counter_ns()
+        entry = self.registry.lookup(msg.nodeid, msg.devid)
+        self._registry_stage.observe(start)
+        self._node_values[msg.nodeid] += 1
+        return (msg, entry, entry.convert(int.from_bytes(msg.payload, byteorder="big")))
+
+
+class Record():
+
+    # A value received from the bridge, decoded once for all the sinks
+    # entry is the bugoneregistry.DeviceEntry of the device, value the
+    # converted value. For an aggregated window (see bugoneaggregate),
+    # timestamp is the start of the window, value the mean and stats is
+    # (count, min, max, mean, last)
+    # timestamp is in seconds, timestamp_ns (ns since Epoch) keeps the
+    # resolution of the message, if any
+
+    __slots__ = ("timestamp", "timestamp_ns", "nodeid", "devid", "entry", "value", "stats")
+
+    def __init__(self, timestamp, nodeid, devid, entry, value, stats = None, timestamp_ns = None):
+        self.timestamp = timestamp
+        self.timestamp_ns = int(timestamp * 1000000000) if timestamp_ns is None else timestamp_ns
+        self.nodeid = nodeid
+        self.devid = devid
+        self.entry = entry
+        self.value = value
+        self.stats = stats
+
+
+class Sink():
+
+    # Base class of the sinks. Subclasses implement handle(records), and
+    # may implement compile(entry) (data precomputed for each device, found
+    # in entry.sink[self.index]), tick() and next_tick() (seconds before tick
+    # must be called, None if not needed) for time-driven work, and
+    # close_sink().
+    # At most queue_size records wait; when the queue is full, policy
+    # decides what happens (see LineProtocolWriter).
+
+    POLICIES = ("block", "drop_oldest", "drop_newest")
+
+    def __init__(self, name, config, metrics = None):
+        self.name = name
+        self.queue_size = config.getint("queue_size", fallback = 10000)
+        self.policy = config.get("queue_full", fallback = "drop_oldest")
+        self.max_batch = config.getint("max_batch", fallback = 1000)
+        if self.policy not in self.POLICIES:
+            raise ValueError("Unknown queue full policy (%s)" % self.policy)
+        self.index = None
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.dropped = 0
+        self.thread = None
+        if metrics is None:
+            metrics = bugonemetrics.Metrics(name)
+        self.metrics = metrics
+        self._handle_stage = metrics.stage("sink." + name)
+        metrics.gauge("sink." + name + ".queued", lambda: len(self.queue))
+        metrics.gauge("sink." + name + ".dropped", lambda: self.dropped)
+
+    def compile(self, entry):
+        return None
+
+    def handle(self, records):
+        raise NotImplementedError
+
+    def tick(self):
+        pass
+
+    def next_tick(self):
+        return None
+
+    def close_sink(self):
+        pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="sink-" + self.name, daemon=True)
+        self.thread.start()
+
+    def put(self, record):
+        with self.cond:
+            if len(self.queue) >= self.queue_size:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return
+                elif self.policy == "drop_oldest":
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.queue) >= self.queue_size and self.running:
+                        self.cond.wait()
+            self.queue.append(record)
+            if len(self.queue) == 1:
+                self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.queue:
+                    wait = self.next_tick()
+                    if wait is not None and wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                if not self.queue and not self.running:
+                    break
+                count = min(len(self.queue), self.max_batch)
+                batch = [self.queue.popleft() for i in range(count)]
+                self.cond.notify_all()
+            if batch:
+                start = bugonemetrics.perf_counter_ns()
+                try:
+                    self.handle(batch)
+                    self._handle_stage.observe(start)
+                except Exception as e:
+                    self._handle_stage.errors += 1
+                    print("Error in sink %s (%s)" % (self.name, e))
+            self.tick()
+        self.close_sink()
+
+
+def spool_from_config(config):
+    if not config.get("spool_dir", fallback = None):
+        return None
+    return bugonespool.Spool(config.get("spool_dir"), max_bytes = config.getint("spool_size", fallback = 512) << 20)
+
+
+class GraphiteSink(Sink):
+
+    # Options: graph_address, port, batch_size, flush_interval (ms),
+    # spool_dir, spool_size (MB)
+    # Aggregated windows are written as <path> (mean), <path>.min, .max,
+    # .count and .last
+
+    def __init__(self, name, config, metrics = None):
+        Sink.__init__(self, name, config, metrics)
+        self.carbon = CarbonSender(config.get("graph_address", fallback = "localhost"), config.get("port", fallback = "2004"),
+                config.getint("batch_size", fallback = 500), config.getint("flush_interval", fallback = 1000) / 1000,
+                metrics = self.metrics, spool = spool_from_config(config))
+
+    def handle(self, records):
+        add = self.carbon.add
+        for r in records:
+            path = r.entry.path
+            if r.stats:
+                (count, vmin, vmax, mean, last) = r.stats
+                add(path, r.timestamp, mean)
+                add(path + ".min", r.timestamp, vmin)
+                add(path + ".max", r.timestamp, vmax)
+                add(path + ".count", r.timestamp, count)
+                add(path + ".last", r.timestamp, last)
+            else:
+                add(path, r.timestamp, r.value)
+
+    def tick(self):
+        self.carbon.tick()
+
+    def next_tick(self):
+        return self.carbon.next_flush()
+
+    def close_sink(self):
+        self.carbon.close()
+
+
+class InfluxDBSink(Sink):
+
+    # Options: address, port, ssl, database, user, password, batch_size,
+    # flush_interval (ms), write_queue_size, write_queue_full (queue of the
+    # writer thread), spool_dir, spool_size (MB)
+    # Aggregated windows are written with value (mean), min, max, count and
+    # last fields
+    # Points are written with ns precision
+
+    def __init__(self, name, config, metrics = None):
+        Sink.__init__(self, name, config, metrics)
+        self.writer = LineProtocolWriter(config.get("address", fallback = "localhost"), config.get("port", fallback = "8086"),
+                config.get("database", fallback = "bugone"), config.get("user", fallback = None),
+                config.get("password", fallback = None), config.getboolean("ssl", fallback = False),
+                config.getint("batch_size", fallback = 5000), config.getint("flush_interval", fallback = 1000) / 1000,
+                config.getint("write_queue_size", fallback = 100000), config.get("write_queue_full", fallback = "block"),
+                precision = "ns", metrics = self.metrics, spool = spool_from_config(config))
+
+    def compile(self, entry):
+        return line_prefix(entry.devicename, entry.tags)
+
+    def handle(self, records):
+        write = self.writer.write
+        index = self.index
+        for r in records:
+            if r.stats:
+                (count, vmin, vmax, mean, last) = r.stats
+                write(r.entry.sink[index], mean, r.timestamp_ns, ",min=" + format_field(vmin) + ",max=" + format_field(vmax) +
+                        ",count=" + format_field(count) + ",last=" + format_field(last))
+            else:
+                write(r.entry.sink[index], r.value, r.timestamp_ns)
+
+    def close_sink(self):
+        self.writer.close()
+
+
+class PrintSink(Sink):
+
+    def handle(self, records):
+        for r in records:
+            if r.stats:
+                print("%s: %s = %s (window of %d values, min %s, max %s)" % \
+                    (r.entry.display, r.entry.path, r.value, r.stats[0], r.stats[1], r.stats[2]))
+            else:
+                print(r.entry.display + ": " + r.entry.path + " = " + str(r.value))
+
+
+class FileSink(Sink):
+
+    # Appends one line per record to path: timestamp, nodeid, devid, path
+    # and value (for a window: mean, min, max, count and last)
+
+    def __init__(self, name, config, metrics = None):
+        Sink.__init__(self, name, config, metrics)
+        self.file = open(config.get("path"), "a")
+
+    def handle(self, records):
+        lines = []
+        for r in records:
+            if r.stats:
+                (count, vmin, vmax, mean, last) = r.stats
+                lines.append("%s %d %d %s %s %s %s %d %s\n" % (r.timestamp, r.nodeid, r.devid, r.entry.path, mean, vmin, vmax, count, last))
+            else:
+                lines.append("%s %d %d %s %s\n" % (r.timestamp, r.nodeid, r.devid, r.entry.path, r.value))
+        self.file.write("".join(lines))
+        self.file.flush()
+
+    def close_sink(self):
+        self.file.close()
+
+
+class StoreSink(Sink):
+
+    # Local history in memory-mapped column files (see bugonestore)
+    # Options: path, chunk_points (points per chunk file), flush_interval
+    # (ms between two flushes of the mapped files to disk)
+
+    def __init__(self, name, config, metrics = None):
+        Sink.__init__(self, name, config, metrics)
+        # NumPy is only needed by this sink
+        import bugonestore
+        self.store = bugonestore.ColumnStore(config.get("path"), config.getint("chunk_points", fallback = 65536))
+        self.flush_interval = config.getint("flush_interval", fallback = 10000) / 1000
+        self._next_flush = time.monotonic() + self.flush_interval
+        self.metrics.gauge("sink." + name + ".written", lambda: self.store.written)
+        self.metrics.gauge("sink." + name + ".out_of_order", lambda: self.store.dropped)
+
+    def handle(self, records):
+        append = self.store.append
+        for r in records:
+            append(r.nodeid, r.devid, r.timestamp_ns, r.value)
+
+    def tick(self):
+        if time.monotonic() >= self._next_flush:
+            self.store.flush()
+            self._next_flush = time.monotonic() + self.flush_interval
+
+    def next_tick(self):
+        return self._next_flush - time.monotonic()
+
+    def close_sink(self):
+        self.store.close()
+
+
+# Sink types, by name of their configuration section
+SINKS = {
+        "graphite": GraphiteSink,
+        "influxdb": InfluxDBSink,
+        "print": PrintSink,
+        "file": FileSink,
+        "store": StoreSink,
+        }
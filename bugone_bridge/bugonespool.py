@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Disk spool for the clients, to keep datapoints while a sink is unavailable
+# Records are appended to segment files (spool-<num>.seg). Each record is a
+# batch of datapoints already encoded for the sink: a header (payload
+# length, number of datapoints) followed by the payload.
+# The read cursor (segment, offset) of the next record to send is kept in
+# spool.cursor, and only moves when the sink acknowledged the records
+# (commit): after a crash, records are sent again rather than lost.
+# Segments which are fully read are deleted. When the spool grows over
+# max_bytes, the oldest segments are deleted (evicted) first.
+# A crash while appending can leave a partial record at the end of the last
+# segment: it is cut off when the spool is opened again.
+
+import collections
+import os
+import struct
+import time
+
+RECORD_HEADER = struct.Struct("<II")
+CURSOR = struct.Struct("<QQ")
+CURSOR_FILE = "spool.cursor"
+
+
+def segment_name(num):
+    return "spool-%08d.seg" % num
+
+
+def list_segments(directory):
+    nums = []
+    for name in os.listdir(directory):
+        if name.startswith("spool-") and name.endswith(".seg"):
+            nums.append(int(name[6:-4]))
+    return sorted(nums)
+
+
+class Spool():
+
+    def __init__(self, directory, segment_bytes = 16 << 20, max_bytes = 512 << 20):
+        self.directory = os.path.expanduser(directory)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok = True)
+
+        self.appended = 0
+        self.drained = 0
+        self.evicted = 0
+        self._drains = collections.deque()
+
+        self.segments = list_segments(self.directory)
+        self.cursor = (self.segments[0] if self.segments else 0, 0)
+        path = os.path.join(self.directory, CURSOR_FILE)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            if len(data) == CURSOR.size:
+                self.cursor = CURSOR.unpack(data)
+        # Segments before the cursor were read but not deleted yet
+        for num in [n for n in self.segments if n < self.cursor[0]]:
+            self._delete(num)
+        if not self.segments:
+            self.cursor = (self.cursor[0], 0)
+        elif self.cursor[0] not in self.segments:
+            self.cursor = (self.segments[0], 0)
+
+        if self.segments:
+            self._truncate_partial(self.segments[-1])
+        self.sizes = dict((num, os.path.getsize(self._path(num))) for num in self.segments)
+        self.pending_points = sum(self._count(num, self.cursor[1] if num == self.cursor[0] else 0) for num in self.segments)
+        if not self.segments:
+            self.segments.append(self.cursor[0])
+            self.sizes[self.cursor[0]] = 0
+        self._writer = open(self._path(self.segments[-1]), "ab")
+
+    def _path(self, num):
+        return os.path.join(self.directory, segment_name(num))
+
+    def _scan(self, num, offset):
+        # (datapoints, end offset) of the complete records of a segment, from
+        # offset
+        count = 0
+        with open(self._path(num), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (length, points) = RECORD_HEADER.unpack(header)
+                if offset + RECORD_HEADER.size + length > size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                offset += RECORD_HEADER.size + length
+                count += points
+        return (count, offset)
+
+    def _count(self, num, offset):
+        # Datapoints in the records of a segment, from offset
+        return self._scan(num, offset)[0]
+
+    def _truncate_partial(self, num):
+        (count, end) = self._scan(num, 0)
+        if end < os.path.getsize(self._path(num)):
+            os.truncate(self._path(num), end)
+
+    def _delete(self, num):
+        try:
+            os.remove(self._path(num))
+        except OSError:
+            pass
+        self.segments.remove(num)
+
+    @property
+    def pending_bytes(self):
+        return sum(self.sizes.values()) - self.cursor[1]
+
+    def empty(self):
+        return self.pending_points == 0
+
+    def append(self, payload, points):
+        if self.sizes[self.segments[-1]] >= self.segment_bytes:
+            self._writer.close()
+            num = self.segments[-1] + 1
+            self.segments.append(num)
+            self.sizes[num] = 0
+            self._writer = open(self._path(num), "ab")
+        self._writer.write(RECORD_HEADER.pack(len(payload), points) + payload)
+        self._writer.flush()
+        self.sizes[self.segments[-1]] += RECORD_HEADER.size + len(payload)
+        self.pending_points += points
+        self.appended += points
+        self._evict()
+
+    def _evict(self):
+        while len(self.segments) > 1 and sum(self.sizes.values()) > self.max_bytes:
+            num = self.segments[0]
+            offset = self.cursor[1] if num == self.cursor[0] else 0
+            lost = self._count(num, offset)
+            self._delete(num)
+            del self.sizes[num]
+            self.pending_points -= lost
+            self.evicted += lost
+            self.cursor = (self.segments[0], 0)
+            self._save_cursor()
+
+    def read(self, max_bytes = 1 << 20):
+        # Returns (records, position): records are (payload, points) from the
+        # cursor, up to max_bytes of payload (at least one record), position
+        # must be given to commit once they were sent
+        (num, offset) = self.cursor
+        records = []
+        size = 0
+        self._writer.flush()
+        while num in self.sizes and size < max_bytes:
+            with open(self._path(num), "rb") as f:
+                f.seek(offset)
+                while size < max_bytes:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    (length, points) = RECORD_HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        break
+                    records.append( (payload, points) )
+                    size += length
+                    offset += RECORD_HEADER.size + length
+            if size >= max_bytes or num == self.segments[-1]:
+                break
+            num = self.segments[self.segments.index(num) + 1]
+            offset = 0
+        if not records:
+            # Nothing left to read: no datapoint is pending
+            self.pending_points = 0
+        return (records, (num, offset))
+
+    def commit(self, position, points):
+        # The records before position were sent (points datapoints)
+        for num in [n for n in self.segments if n < position[0]]:
+            self._delete(num)
+            del self.sizes[num]
+        self.cursor = position
+        self._save_cursor()
+        self.pending_points -= points
+        self.drained += points
+        now = time.monotonic()
+        self._drains.append( (now, points) )
+        while self._drains and self._drains[0][0] < now - 10:
+            self._drains.popleft()
+        if self.pending_points <= 0 and self.segments == [position[0]] and position[1] == self.sizes[position[0]]:
+            # Everything was sent: start again with an empty segment
+            self.pending_points = 0
+            self._writer.close()
+            self._delete(position[0])
+            del self.sizes[position[0]]
+            num = position[0] + 1
+            self.segments.append(num)
+            self.sizes[num] = 0
+            self._writer = open(self._path(num), "ab")
+            self.cursor = (num, 0)
+            self._save_cursor()
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "wb") as f:
+            f.write(CURSOR.pack(*self.cursor))
+        os.replace(path + ".tmp", path)
+
+    def drain_rate(self):
+        # Datapoints sent from the spool per second, over the last 10 seconds
+        now = time.monotonic()
+        return sum(n for (t, n) in self._drains if t >= now - 10) / 10.0
+
+    def close(self):
+        self._writer.close()
+
+    def register_metrics(self, metrics, name):
+        metrics.gauge(name + ".depth", lambda: self.pending_points)
+        metrics.gauge(name + ".bytes", lambda: self.pending_bytes)
+        metrics.gauge(name + ".drained", lambda: self.drained)
+        metrics.gauge(name + ".evicted", lambda: self.evicted)
+        metrics.gauge(name + ".drain_rate", self.drain_rate)
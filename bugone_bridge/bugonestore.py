@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Local columnar time-series store
+# Each device (nodeid, devid) has its own directory, holding fixed size
+# chunk files which are memory-mapped. A chunk starts with a 16 bytes header
+# (magic, point count), followed by two columns: timestamps (ns since Epoch,
+# int64) then values (float32), chunk_points of each.
+# A small index per device (one (first timestamp, chunk) record per chunk)
+# finds the chunks of a time range without opening the others.
+# Points of a device are appended in time order: a point older than the
+# last one of its device is dropped (and counted).
+# Readers get NumPy views on the mapped files: a range query does not copy
+# the points, and downsampling reduces the views directly.
+
+import bisect
+import mmap
+import os
+import struct
+
+import numpy
+
+MAGIC = b"B1COL\x00\x01\x00"
+HEADER = struct.Struct("<8sQ")
+INDEX = struct.Struct("<qI")
+INDEX_FILE = "index"
+
+
+def series_name(nodeid, devid):
+    return "node%03d.dev%03d" % (nodeid, devid)
+
+
+def chunk_name(num):
+    return "chunk-%08d.col" % num
+
+
+def chunk_size(points):
+    return HEADER.size + points * 12
+
+
+def chunk_columns(mm, points, count):
+    # (timestamps, values) views on the first count points of a chunk
+    timestamps = numpy.frombuffer(mm, numpy.int64, count, HEADER.size)
+    values = numpy.frombuffer(mm, numpy.float32, count, HEADER.size + points * 8)
+    return (timestamps, values)
+
+
+class SeriesWriter():
+
+    def __init__(self, directory, chunk_points):
+        self.directory = directory
+        self.chunk_points = chunk_points
+        os.makedirs(directory, exist_ok = True)
+        self._index = open(os.path.join(directory, INDEX_FILE), "ab")
+        self._mm = None
+        self.last = None
+        self.dropped = 0
+        chunks = sorted(int(n[6:-4]) for n in os.listdir(directory) if n.startswith("chunk-"))
+        self._open(chunks[-1] if chunks else 0)
+        if self._count:
+            self.last = int(self._timestamps[self._count - 1])
+
+    def _open(self, num):
+        path = os.path.join(self.directory, chunk_name(num))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, chunk_size(self.chunk_points))
+                self._mm = mmap.mmap(fd, chunk_size(self.chunk_points))
+                HEADER.pack_into(self._mm, 0, MAGIC, 0)
+            else:
+                self._mm = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        (magic, self._count) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a column chunk" % path)
+        self._num = num
+        # Existing chunks keep the size they were created with
+        self._capacity = (len(self._mm) - HEADER.size) // 12
+        (self._timestamps, self._values) = chunk_columns(self._mm, self._capacity, self._capacity)
+
+    def append(self, timestamp_ns, value):
+        if self.last is not None and timestamp_ns < self.last:
+            self.dropped += 1
+            return False
+        count = self._count
+        if count >= self._capacity:
+            self._close_chunk()
+            self._open(self._num + 1)
+            count = 0
+        if count == 0:
+            self._index.write(INDEX.pack(timestamp_ns, self._num))
+            self._index.flush()
+        self._timestamps[count] = timestamp_ns
+        self._values[count] = value
+        self._count = count + 1
+        # The count is updated last: a reader never sees a partial point
+        HEADER.pack_into(self._mm, 0, MAGIC, self._count)
+        self.last = timestamp_ns
+        return True
+
+    def _close_chunk(self):
+        # Views must be released before the map is closed
+        (self._timestamps, self._values) = (None, None)
+        self._mm.flush()
+        self._mm.close()
+
+    def flush(self):
+        self._mm.flush()
+        self._index.flush()
+
+    def close(self):
+        self._close_chunk()
+        self._index.close()
+
+
+class ColumnStore():
+
+    # Writer side: append(nodeid, devid, timestamp_ns, value)
+
+    def __init__(self, directory, chunk_points = 65536):
+        self.directory = directory
+        self.chunk_points = chunk_points
+        self.series = {}
+        self.written = 0
+        os.makedirs(directory, exist_ok = True)
+
+    def append(self, nodeid, devid, timestamp_ns, value):
+        series = self.series.get( (nodeid, devid) )
+        if series is None:
+            series = SeriesWriter(os.path.join(self.directory, series_name(nodeid, devid)), self.chunk_points)
+            self.series[ (nodeid, devid) ] = series
+        if series.append(timestamp_ns, value):
+            self.written += 1
+
+    @property
+    def dropped(self):
+        return sum(s.dropped for s in self.series.values())
+
+    def flush(self):
+        for s in self.series.values():
+            s.flush()
+
+    def close(self):
+        for s in self.series.values():
+            s.close()
+        self.series = {}
+
+
+class ColumnReader():
+
+    # Read side, which can run while a ColumnStore appends to the same
+    # directory. Chunks are mapped once and kept: the arrays returned are
+    # views on the files, valid as long as the reader.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._maps = {}
+
+    def devices(self):
+        devices = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith("node") and ".dev" in name:
+                (node, dev) = name.split(".")
+                devices.append( (int(node[4:]), int(dev[3:])) )
+        return devices
+
+    def _index(self, path):
+        try:
+            with open(os.path.join(path, INDEX_FILE), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        usable = len(data) - len(data) % INDEX.size
+        return [e for e in INDEX.iter_unpack(data[:usable])]
+
+    def _chunk(self, path, num):
+        key = (path, num)
+        mm = self._maps.get(key)
+        if mm is None:
+            with open(os.path.join(path, chunk_name(num)), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            self._maps[key] = mm
+        (magic, count) = HEADER.unpack_from(mm, 0)
+        return chunk_columns(mm, (len(mm) - HEADER.size) // 12, count)
+
+    def query(self, nodeid, devid, start_ns = None, end_ns = None):
+        # Points with start_ns <= timestamp < end_ns, as a list of
+        # (timestamps, values) views, one per chunk, oldest first
+        path = os.path.join(self.directory, series_name(nodeid, devid))
+        index = self._index(path)
+        first = 0
+        if start_ns is not None:
+            # Last chunk starting before start_ns: it may hold the first
+            # points of the range
+            first = max(bisect.bisect_left(index, (start_ns, )) - 1, 0)
+        parts = []
+        for (chunk_start, num) in index[first:]:
+            if end_ns is not None and chunk_start >= end_ns:
+                break
+            (timestamps, values) = self._chunk(path, num)
+            lo = 0 if start_ns is None else numpy.searchsorted(timestamps, start_ns, "left")
+            hi = len(timestamps) if end_ns is None else numpy.searchsorted(timestamps, end_ns, "left")
+            if hi > lo:
+                parts.append( (timestamps[lo:hi], values[lo:hi]) )
+        return parts
+
+    def points(self, nodeid, devid, start_ns = None, end_ns = None):
+        # Same as query, as a single pair of arrays (copied only when the
+        # range spans several chunks)
+        parts = self.query(nodeid, devid, start_ns, end_ns)
+        if not parts:
+            return (numpy.empty(0, numpy.int64), numpy.empty(0, numpy.float32))
+        if len(parts) == 1:
+            return parts[0]
+        return (numpy.concatenate([t for (t, v) in parts]), numpy.concatenate([v for (t, v) in parts]))
+
+    def downsample(self, nodeid, devid, start_ns, end_ns, step_ns):
+        # Buckets of step_ns ns from start_ns to end_ns: returns (starts,
+        # count, mean, min, max) arrays, mean/min/max being NaN for empty
+        # buckets
+        buckets = -(-(end_ns - start_ns) // step_ns)
+        starts = start_ns + numpy.arange(buckets, dtype = numpy.int64) * step_ns
+        count = numpy.zeros(buckets, numpy.int64)
+        total = numpy.zeros(buckets, numpy.float64)
+        vmin = numpy.full(buckets, numpy.inf)
+        vmax = numpy.full(buckets, -numpy.inf)
+        edges_at = numpy.append(starts, end_ns)
+        for (timestamps, values) in self.query(nodeid, devid, start_ns, end_ns):
+            # Points are sorted: bucket boundaries are found by bisection
+            edges = numpy.searchsorted(timestamps, edges_at, "left")
+            sizes = numpy.diff(edges)
+            used = numpy.flatnonzero(sizes)
+            if not len(used):
+                continue
+            offsets = edges[used] - edges[used[0]]
+            segment = values[edges[used[0]]:edges[used[-1] + 1]]
+            count[used] += sizes[used]
+            total[used] += numpy.add.reduceat(segment, offsets, dtype = numpy.float64)
+            vmin[used] = numpy.minimum(vmin[used], numpy.minimum.reduceat(segment, offsets))
+            vmax[used] = numpy.maximum(vmax[used], numpy.maximum.reduceat(segment, offsets))
+        empty = count == 0
+        with numpy.errstate(invalid = "ignore", divide = "ignore"):
+            mean = total / count
+        mean[empty] = numpy.nan
+        vmin[empty] = numpy.nan
+        vmax[empty] = numpy.nan
+        return (starts, count, mean, vmin, vmax)
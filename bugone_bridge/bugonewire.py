@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# zMQ message format shared by bugone_zmq and its clients (see
+# bugone_zmq/README.md)
+# A zMQ message may hold a batch of messages: each frame of a multipart
+# message is one message.
+# Two formats exist:
+# - legacy: timestamp first, then type, nodeid, devid and payload
+# - topic: a version byte, type, nodeid and devid first, so that
+#   subscribers can filter on a prefix, then payload and timestamp
+# The first byte of a legacy message is the high byte of the timestamp (0
+# for the next few thousand years), so both formats can be told apart.
+# Layouts are precompiled struct.Struct, and messages are decoded from a
+# memoryview (see decode_message), without copying the payload.
+# Topic format versions:
+# - 0xB4 (current): the payload is followed by the sequence number of the
+#   message, the time the frame was received from the sniffer and the time
+#   it was published (ingest), both in ns since Epoch (8 bytes each)
+# - 0xB3: sequence number and timestamp in seconds
+# - 0xB2: timestamp in seconds only
+# Older versions and the legacy format (seconds) are still decoded, and
+# subscribe() subscribes to all the versions known here, so that clients
+# keep working with an older bridge. A client cannot read a newer version:
+# clients must be upgraded before the bridge. decode_message raises
+# ValueError for an unknown version.
+#
+# The bridge can also serve a snapshot of the latest value of every device
+# (see request_snapshot). The reply holds the sequence number of the last
+# message taken into account, then one topic message per device and node
+# status: live messages with a lower or equal sequence number are already in
+# the snapshot (see in_snapshot).
+# The 24 high bits of a sequence number are a session id, drawn at random
+# when the bridge starts, the 40 low bits count the messages of the session.
+# A restarted bridge counts from 0 again, in another session: its messages
+# are never taken for messages already in a snapshot of the previous one.
+#
+# Commands (see bugonecommand) are multipart messages: a request id chosen
+# by the client (echoed in the reply, so that a client can have several
+# requests in flight), the command (GET or SET), nodeid and devid (2 bytes),
+# and for SET the value, as published (2 bytes big endian for an integer,
+# a string otherwise). The reply holds the request id, a status (OK,
+# TIMEOUT or ERROR) and the value reported by the node (or an error
+# message).
+
+import os
+import struct
+import time
+import zmq
+
+MSG_CONFIG = 0
+MSG_VALUES = 1
+MSG_STATUS = 2
+
+FORMAT_LEGACY = "legacy"
+FORMAT_TOPIC = "topic"
+FORMATS = (FORMAT_LEGACY, FORMAT_TOPIC)
+
+TOPIC_VERSION = 0xB4
+TOPIC_VERSION_SEQ = 0xB3
+TOPIC_VERSION_NOSEQ = 0xB2
+TOPIC_VERSIONS = (TOPIC_VERSION, TOPIC_VERSION_SEQ, TOPIC_VERSION_NOSEQ)
+
+# timestamp (s), type, nodeid, devid (or status)
+LEGACY_HEADER = struct.Struct(">QBBB")
+# version, type, nodeid, devid (or status)
+TOPIC_HEADER = struct.Struct(">BBBB")
+# sequence, timestamp (ns), ingest timestamp (ns)
+TOPIC_TRAILER = struct.Struct(">QQQ")
+# sequence, timestamp (s) (0xB3)
+TOPIC_TRAILER_SEQ = struct.Struct(">QQ")
+# timestamp (s) (0xB2)
+TOPIC_TRAILER_NOSEQ = struct.Struct(">Q")
+
+NS = 1000000000
+
+SESSION_SHIFT = 40
+
+SNAPSHOT_REQUEST = b"SNAPSHOT"
+
+COMMAND_GET = b"GET"
+COMMAND_SET = b"SET"
+COMMAND_OK = b"OK"
+COMMAND_TIMEOUT = b"TIMEOUT"
+COMMAND_ERROR = b"ERROR"
+# Longest string a SET can carry: a 32 bytes packet holds a 6 bytes header,
+# the value (4 bytes plus the string) and the end marker (5 bytes)
+MAX_SET_STRING = 17
+
+
+def encode_values(nodeid, devid, value, timestamp = None, msgtype = MSG_VALUES):
+    # Legacy format, timestamp in seconds
+    if timestamp is None:
+        timestamp = int(time.time())
+    return LEGACY_HEADER.pack(timestamp, msgtype, nodeid, devid) + value
+
+
+def encode_status(nodeid, status, timestamp = None):
+    if timestamp is None:
+        timestamp = int(time.time())
+    return LEGACY_HEADER.pack(timestamp, MSG_STATUS, nodeid, 0xFF if status else 0x00)
+
+
+def topic(msgtype, nodeid = None, devid = None, version = TOPIC_VERSION):
+    # Subscription prefix for the topic format. Leave nodeid and/or devid
+    # out to subscribe to all nodes and/or devices
+    prefix = bytes((version, msgtype))
+    if nodeid is not None:
+        prefix += bytes((nodeid,))
+        if devid is not None:
+            prefix += bytes((devid,))
+    return prefix
+
+
+def encode_topic_values(nodeid, devid, value, timestamp_ns = None, msgtype = MSG_VALUES, sequence = 0, ingest_ns = None):
+    # timestamp_ns is the time the frame was received, ingest_ns the time it
+    # is published (now by default)
+    if ingest_ns is None:
+        ingest_ns = time.time_ns()
+    if timestamp_ns is None:
+        timestamp_ns = ingest_ns
+    return TOPIC_HEADER.pack(TOPIC_VERSION, msgtype, nodeid, devid) + value + \
+            TOPIC_TRAILER.pack(sequence, timestamp_ns, ingest_ns)
+
+
+def encode_topic_status(nodeid, status, timestamp_ns = None, sequence = 0, ingest_ns = None):
+    if ingest_ns is None:
+        ingest_ns = time.time_ns()
+    if timestamp_ns is None:
+        timestamp_ns = ingest_ns
+    return TOPIC_HEADER.pack(TOPIC_VERSION, MSG_STATUS, nodeid, 0xFF if status else 0x00) + \
+            TOPIC_TRAILER.pack(sequence, timestamp_ns, ingest_ns)
+
+
+class Message():
+
+    # A decoded message. payload is a memoryview on the received message.
+    # devid is None for status messages (the status is the payload).
+    # sequence and ingest_ns are None if the format has none.
+
+    __slots__ = ("msgtype", "nodeid", "devid", "payload", "sequence", "timestamp_ns", "ingest_ns")
+
+    def __init__(self, msgtype, nodeid, devid, payload, sequence, timestamp_ns, ingest_ns):
+        self.msgtype = msgtype
+        self.nodeid = nodeid
+        self.devid = devid
+        self.payload = payload
+        self.sequence = sequence
+        self.timestamp_ns = timestamp_ns
+        self.ingest_ns = ingest_ns
+
+    @property
+    def timestamp(self):
+        # In seconds
+        return self.timestamp_ns // NS
+
+
+def decode_message(message):
+    view = memoryview(message)
+    version = view[0]
+    if version == TOPIC_VERSION:
+        end = len(view) - TOPIC_TRAILER.size
+        (seq, timestamp_ns, ingest_ns) = TOPIC_TRAILER.unpack_from(view, end)
+    elif version == TOPIC_VERSION_SEQ:
+        end = len(view) - TOPIC_TRAILER_SEQ.size
+        (seq, timestamp) = TOPIC_TRAILER_SEQ.unpack_from(view, end)
+        (timestamp_ns, ingest_ns) = (timestamp * NS, None)
+    elif version == TOPIC_VERSION_NOSEQ:
+        end = len(view) - TOPIC_TRAILER_NOSEQ.size
+        (timestamp, ) = TOPIC_TRAILER_NOSEQ.unpack_from(view, end)
+        (seq, timestamp_ns, ingest_ns) = (None, timestamp * NS, None)
+    elif version != 0:
+        # The first byte of a legacy message is the high byte of a timestamp
+        # in seconds, always 0
+        raise ValueError("Unknown message format version 0x%02X (the bridge is newer than this client?)" % version)
+    else:
+        (timestamp, msgtype, nodeid, devid) = LEGACY_HEADER.unpack_from(view, 0)
+        if msgtype == MSG_STATUS:
+            return Message(msgtype, nodeid, None, view[LEGACY_HEADER.size - 1:], None, timestamp * NS, None)
+        return Message(msgtype, nodeid, devid, view[LEGACY_HEADER.size:], None, timestamp * NS, None)
+    (version, msgtype, nodeid, devid) = TOPIC_HEADER.unpack_from(view, 0)
+    if msgtype == MSG_STATUS:
+        return Message(msgtype, nodeid, None, view[TOPIC_HEADER.size - 1:end], seq, timestamp_ns, ingest_ns)
+    return Message(msgtype, nodeid, devid, view[TOPIC_HEADER.size:end], seq, timestamp_ns, ingest_ns)
+
+
+def decode(message):
+    # Returns (timestamp, msgtype, nodeid, devid, payload), timestamp in
+    # seconds. devid is None for status messages
+    m = decode_message(message)
+    return (m.timestamp, m.msgtype, m.nodeid, m.devid, bytes(m.payload))
+
+
+def sequence(message):
+    # Sequence number of a message, None if its format has none
+    if message[0] == TOPIC_VERSION:
+        return TOPIC_TRAILER.unpack_from(message, len(message) - TOPIC_TRAILER.size)[0]
+    if message[0] == TOPIC_VERSION_SEQ:
+        return TOPIC_TRAILER_SEQ.unpack_from(message, len(message) - TOPIC_TRAILER_SEQ.size)[0]
+    return None
+
+
+def new_session():
+    # First sequence number of a new bridge session
+    return (int.from_bytes(os.urandom(3), byteorder = "big") or 1) << SESSION_SHIFT
+
+
+def session(sequence):
+    return sequence >> SESSION_SHIFT
+
+
+def in_snapshot(sequence, snapshot_sequence):
+    # True if the live message with this sequence number is already in the
+    # snapshot: it comes from the same bridge session, and is not newer
+    if sequence is None or snapshot_sequence is None:
+        return False
+    return session(sequence) == session(snapshot_sequence) and sequence <= snapshot_sequence
+
+
+def subscribe(socket, wire_format, devices = None, status = False):
+    # Subscribe to values and configs of the given (nodeid, devid) devices,
+    # and with status, to the status of their nodes.
+    # With the legacy format, or without a device list, everything is
+    # received and filtering is up to the subscriber
+    if wire_format != FORMAT_TOPIC:
+        socket.setsockopt(zmq.SUBSCRIBE, b"")
+        return
+    for version in TOPIC_VERSIONS:
+        if devices is None:
+            socket.setsockopt(zmq.SUBSCRIBE, topic(MSG_VALUES, version = version))
+            socket.setsockopt(zmq.SUBSCRIBE, topic(MSG_CONFIG, version = version))
+            if status:
+                socket.setsockopt(zmq.SUBSCRIBE, topic(MSG_STATUS, version = version))
+            continue
+        for (nodeid, devid) in devices:
+            socket.setsockopt(zmq.SUBSCRIBE, topic(MSG_VALUES, nodeid, devid, version))
+            socket.setsockopt(zmq.SUBSCRIBE, topic(MSG_CONFIG, nodeid, devid, version))
+        if status:
+            for nodeid in sorted(set(nodeid for (nodeid, devid) in devices)):
+                socket.setsockopt(zmq.SUBSCRIBE, topic(MSG_STATUS, nodeid, version = version))
+
+
+def recv_messages(socket, flags = 0):
+    # Receive one zMQ message and return the list of messages it holds,
+    # whether the publisher batches or not
+    return socket.recv_multipart(flags)
+
+
+def encode_snapshot_request(devices = None):
+    # Frames of a snapshot request. devices is a list of (nodeid, devid),
+    # devid being None for all the devices of a node. Without devices, the
+    # whole table is requested
+    frames = [SNAPSHOT_REQUEST]
+    for (nodeid, devid) in devices or ():
+        frames.append(bytes((nodeid,)) if devid is None else bytes((nodeid, devid)))
+    return frames
+
+
+def decode_snapshot_request(frames):
+    # Returns the list of requested (nodeid, devid), None for everything, or
+    # raises ValueError
+    if not frames or frames[0] != SNAPSHOT_REQUEST:
+        raise ValueError("Not a snapshot request")
+    if len(frames) == 1:
+        return None
+    devices = []
+    for frame in frames[1:]:
+        if len(frame) == 1:
+            devices.append( (frame[0], None) )
+        elif len(frame) == 2:
+            devices.append( (frame[0], frame[1]) )
+        else:
+            raise ValueError("Invalid device in snapshot request")
+    return devices
+
+
+def request_snapshot(socket, devices = None, timeout = 5.0):
+    # Request a snapshot on a REQ socket connected to the snapshot service
+    # Returns (sequence, messages), or None if no reply came within timeout
+    # seconds (the socket must then be closed: a REQ socket cannot send a
+    # new request before it got a reply)
+    socket.send_multipart(encode_snapshot_request(devices))
+    if not socket.poll(timeout * 1000):
+        return None
+    reply = socket.recv_multipart()
+    return (int.from_bytes(reply[0], byteorder = "big"), reply[1:])
+
+
+def encode_command(request_id, command, nodeid, devid, value = b""):
+    return [request_id, command, bytes((nodeid, devid)), value]
+
+
+def decode_command(frames):
+    # Returns (request_id, command, nodeid, devid, value), or raises
+    # ValueError
+    if len(frames) < 3 or frames[1] not in (COMMAND_GET, COMMAND_SET) or len(frames[2]) != 2:
+        raise ValueError("Invalid command")
+    value = frames[3] if len(frames) > 3 else b""
+    if frames[1] == COMMAND_SET and not value:
+        raise ValueError("SET without a value")
+    if frames[1] == COMMAND_SET and len(value) > MAX_SET_STRING:
+        raise ValueError("SET value too long (%d bytes, at most %d)" % (len(value), MAX_SET_STRING))
+    return (frames[0], frames[1], frames[2][0], frames[2][1], value)
+
+
+def encode_command_reply(request_id, status, value = b""):
+    return [request_id, status, value]
+
+
+def decode_command_reply(frames):
+    # Returns (request_id, status, value)
+    return (frames[0], frames[1], frames[2] if len(frames) > 2 else b"")
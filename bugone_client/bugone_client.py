@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+"""
+Copyright 2017 Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+
+This is free software: you can redistribute it and/or modify it
+under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful, but
+WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see
+<http://www.gnu.org/licenses/>.
+
+@author: Pierre-Henri Horrein <ph.horrein@frekilabs.fr>
+@license: GPL(v3)
+"""
+
+# Unified client: subscribes once to the bridge, decodes each message once
+# and gives it to several sinks (see bugonesink), configured in a single
+# file. Each sink has its own queue and thread.
+
+import time
+import configparser
+import argparse
+import os
+import sys
+import zmq
+import bugonewire
+import bugoneregistry
+import bugonemetrics
+import bugoneaggregate
+import bugonesink
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BugOne zMQ client writing to several sinks")
+    parser.add_argument("-c","--config",required=True)
+
+    args = parser.parse_args()
+
+    #Default values for parameters (overriden by the config file)
+    pub_address = "127.0.0.1"
+    pub_port = "40666"
+    wire_format = bugonewire.FORMAT_LEGACY
+    bugone_network_db = "/etc/bugone_client/bugone_network_db.yaml"
+    sink_names = []
+    metrics_address = "127.0.0.1"
+    metrics_port = None
+    aggregate = True
+    aggregate_max_devices = 4096
+    aggregate_grace = 1.0
+
+    confpath = os.path.expanduser(args.config)
+    if not os.access(confpath,os.R_OK):
+        print("Error: config file not readable (%s)" % confpath)
+        sys.exit(1)
+    confparser = configparser.ConfigParser()
+    confparser.read(confpath)
+    try:
+        pub_address = confparser.get('Server','address')
+        pub_port = confparser.get('Server','port')
+        wire_format = confparser.get('Server','format', fallback = wire_format)
+        bugone_network_db = confparser.get('BugOne','bugone_network_db')
+        sink_names = [n.strip() for n in confparser.get('Client','sinks').split(",") if n.strip()]
+        metrics_address = confparser.get('Metrics','address', fallback = metrics_address)
+        metrics_port = confparser.get('Metrics','http_port', fallback = metrics_port)
+        aggregate = confparser.getboolean('Aggregation','enabled', fallback = aggregate)
+        aggregate_max_devices = confparser.getint('Aggregation','max_devices', fallback = aggregate_max_devices)
+        aggregate_grace = confparser.getfloat('Aggregation','grace', fallback = aggregate_grace)
+    except (configparser.NoSectionError, configparser.NoOptionError) as e:
+        print("Unrecognized config file format (%s)" % e)
+        sys.exit(1)
+
+    metrics = bugonemetrics.Metrics("client")
+    if metrics_port:
+        metrics.serve_http(metrics_address, metrics_port)
+
+    # Each sink is described by the section of the same name. Its type is
+    # the type option, or the name of the section
+    sinks = []
+    for name in sink_names:
+        if not confparser.has_section(name):
+            print("No section for sink %s" % name)
+            sys.exit(1)
+        section = confparser[name]
+        sink_type = section.get("type", fallback = name.lower())
+        if sink_type not in bugonesink.SINKS:
+            print("Unknown sink type (%s)" % sink_type)
+            sys.exit(1)
+        try:
+            sink = bugonesink.SINKS[sink_type](name, section, metrics)
+        except (OSError, ValueError) as e:
+            print("Cannot create sink %s (%s)" % (name, e))
+            sys.exit(1)
+        sink.index = len(sinks)
+        sinks.append(sink)
+    if not sinks:
+        print("No sink configured")
+        sys.exit(1)
+
+    print("DB file: ", bugone_network_db)
+    try:
+        registry = bugoneregistry.DeviceRegistry(bugone_network_db, lambda entry: tuple(sink.compile(entry) for sink in sinks))
+    except Exception as e:
+        print("Error while loading network description (%s)" % e)
+        sys.exit(1)
+    reader = bugonesink.MessageReader(registry, metrics)
+
+    for sink in sinks:
+        sink.start()
+
+    def fan_out(record):
+        for sink in sinks:
+            sink.put(record)
+
+    aggregator = None
+    if aggregate:
+        def emit(entry, start, count, vmin, vmax, mean, last):
+            fan_out(bugonesink.Record(start, entry.nodeid, entry.devid, entry, mean, (count, vmin, vmax, mean, last)))
+        aggregator = bugoneaggregate.WindowAggregator(emit, aggregate_max_devices, aggregate_grace)
+        metrics.gauge("aggregate.values", lambda: aggregator.values)
+        metrics.gauge("aggregate.windows", lambda: aggregator.emitted)
+
+    context = zmq.Context()
+    subscriber = context.socket(zmq.SUB)
+    subscriber.connect("tcp://"+pub_address+":"+pub_port)
+    subscribed = set(registry.devices())
+    bugonewire.subscribe(subscriber, wire_format, subscribed)
+    poller = zmq.Poller()
+    poller.register(subscriber, zmq.POLLIN)
+
+    try:
+        while True:
+            if registry.maybe_reload() and wire_format == bugonewire.FORMAT_TOPIC:
+                added = set(registry.devices()) - subscribed
+                bugonewire.subscribe(subscriber, wire_format, added)
+                subscribed |= added
+            if aggregator:
+                aggregator.tick(time.time())
+            if not poller.poll(1000):
+                continue
+            for message in bugonewire.recv_messages(subscriber):
+                reading = reader.read(message)
+                if reading is None:
+                    continue
+                (msg, entry, value) = reading
+                if aggregator and aggregator.add(entry, msg.timestamp, value):
+                    continue
+                fan_out(bugonesink.Record(msg.timestamp, msg.nodeid, msg.devid, entry, value, timestamp_ns = msg.timestamp_ns))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if aggregator:
+            aggregator.flush()
+        for sink in sinks:
+            sink.close()
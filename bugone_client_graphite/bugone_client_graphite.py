@@ -22,76 +22,18 @@ along with this program.  If not, see
 """
 
 import time
-import logging
-import logging.handlers
 import configparser
 import argparse
 import os
 import sys
 import zmq
-import bugonehelper
-import pickle
-import struct
-import voluptuous
-import yaml
-import socket
-
-def format_float_value(v):
-    return float(v)/10
-
-def format_mil_value(v):
-    return float(v)/1000
-
-def format_bool_value(v):
-    return False if v == 0 else True
-
-datatype = {
-        "temperature": format_float_value,
-        "humidity": format_float_value,
-        "voltage": format_mil_value,
-        "switch": format_bool_value
-        }
-
-device = {
-        voluptuous.Optional("display"): str,
-        voluptuous.Required("type"): str,
-        voluptuous.Required("nodeid"): int,
-        voluptuous.Required("devid"): int,
-        voluptuous.Optional("format"): int
-}
-node = {
-        voluptuous.Required("location"): str,
-        voluptuous.Optional("display"): str,
-        voluptuous.Required("nodeid"): int,
-        voluptuous.Required("address"): str
-}
-
-
-
-def validate_db(db):
-    schema = voluptuous.Schema({
-        voluptuous.Optional("name"): str,
-        voluptuous.Required("nodes"): [node],
-        voluptuous.Required("devices"): [device]
-    })
-    try: 
-        schema(db)
-    except voluptuous.MultipleInvalid as e:
-        print(e)
-
-
-def extract_db(yaml_path):
-        if not os.access(os.path.expanduser(yaml_path),os.R_OK):
-            print("Error: config file not readable (%s)" % yaml_path)
-            sys.exit(1)
-        try:
-            yaml_file = open(os.path.expanduser(yaml_path),'r')
-        except:
-            print("Error while opening configuration file")
-            sys.exit(1)
-        db = yaml.load(yaml_file)
-        validate_db(db) 
-        return db
+import bugonewire
+import bugoneregistry
+import bugonemetrics
+import bugoneaggregate
+import bugonespool
+import bugonesink
+
 
 if __name__ == "__main__":
     # First, let's parse arguments
@@ -107,6 +49,18 @@ if __name__ == "__main__":
     pub_address = "127.0.0.1"
     pub_port = "40666"
     bugone_network_db = "/etc/bugone_client/bugone_network_db.yaml"
+    wire_format = bugonewire.FORMAT_LEGACY
+    metrics_address = "127.0.0.1"
+    metrics_port = None
+    graph_address = "localhost"
+    graph_port = "2004"
+    graph_batch_size = 500
+    graph_flush_interval = 1000
+    graph_spool_dir = None
+    graph_spool_size = 512
+    aggregate = True
+    aggregate_max_devices = 4096
+    aggregate_grace = 1.0
 
 
     if args.config: 
@@ -126,7 +80,19 @@ if __name__ == "__main__":
             log_file = confparser.get('General','log_file')
             pub_address = confparser.get('Server','address')
             pub_port = confparser.get('Server','port')
+            wire_format = confparser.get('Server','format', fallback = wire_format)
+            metrics_address = confparser.get('Metrics','address', fallback = metrics_address)
+            metrics_port = confparser.get('Metrics','http_port', fallback = metrics_port)
             bugone_network_db = confparser.get('BugOne','bugone_network_db')
+            graph_address = confparser.get('Graphite','graph_address')
+            graph_port = confparser.get('Graphite','port')
+            graph_batch_size = confparser.getint('Graphite','batch_size', fallback = graph_batch_size)
+            graph_flush_interval = confparser.getint('Graphite','flush_interval', fallback = graph_flush_interval)
+            graph_spool_dir = confparser.get('Graphite','spool_dir', fallback = graph_spool_dir)
+            graph_spool_size = confparser.getint('Graphite','spool_size', fallback = graph_spool_size)
+            aggregate = confparser.getboolean('Aggregation','enabled', fallback = aggregate)
+            aggregate_max_devices = confparser.getint('Aggregation','max_devices', fallback = aggregate_max_devices)
+            aggregate_grace = confparser.getfloat('Aggregation','grace', fallback = aggregate_grace)
         except configparser.NoSectionError:
             print("Unrecognized config file format")
             sys.exit(1)
@@ -135,44 +101,67 @@ if __name__ == "__main__":
 
 
     print("DB file: ", bugone_network_db)
-    bugone_desc = extract_db(bugone_network_db)
+    metrics = bugonemetrics.Metrics("graphite")
+    if metrics_port:
+        metrics.serve_http(metrics_address, metrics_port)
+
+    try:
+        registry = bugoneregistry.DeviceRegistry(bugone_network_db)
+    except Exception as e:
+        print("Error while loading network description (%s)" % e)
+        sys.exit(1)
+    reader = bugonesink.MessageReader(registry, metrics)
 
 
 
     context = zmq.Context()
     subscriber = context.socket(zmq.SUB)
-    url = "tcp://"+pubaddress+":"+pub_port
+    url = "tcp://"+pub_address+":"+pub_port
     subscriber.connect(url)
-    subscriber.setsockopt(zmq.SUBSCRIBE,b"")
+    subscribed = set(registry.devices())
+    bugonewire.subscribe(subscriber, wire_format, subscribed)
+
+    spool = None
+    if graph_spool_dir:
+        spool = bugonespool.Spool(graph_spool_dir, max_bytes = graph_spool_size << 20)
+    carbon = bugonesink.CarbonSender(graph_address, graph_port, graph_batch_size, graph_flush_interval / 1000, metrics = metrics,
+            spool = spool)
+    poller = zmq.Poller()
+    poller.register(subscriber, zmq.POLLIN)
+
+    aggregator = None
+    if aggregate:
+        # Devices with an aggregation window get one point per window and
+        # statistic: <path> (mean), <path>.min, .max, .count and .last
+        def emit(entry, start, count, vmin, vmax, mean, last):
+            carbon.add(entry.path, start, mean)
+            carbon.add(entry.path + ".min", start, vmin)
+            carbon.add(entry.path + ".max", start, vmax)
+            carbon.add(entry.path + ".count", start, count)
+            carbon.add(entry.path + ".last", start, last)
+        aggregator = bugoneaggregate.WindowAggregator(emit, aggregate_max_devices, aggregate_grace)
+        metrics.gauge("aggregate.values", lambda: aggregator.values)
+        metrics.gauge("aggregate.windows", lambda: aggregator.emitted)
 
     while True:
-        message = subscriber.recv()
-        timestamp = int.from_bytes(message[0:8], byteorder = "big")
-        msgtype = message[8]
-        nodeid = message[9]
-        if msgtype < 2:
-            devid = message[10]
-            display_name = "Device " + str(nodeid) + "," + str(devid)
-            address = "node" + str(nodeid)
-            devicename = "dev" + str(devid)
-            value = int.from_bytes(message[11:], byteorder="big")
-            for node in bugone_desc["nodes"]:
-                if node["nodeid"] == nodeid:
-                    address = node["address"]
-                    break
-            for device in bugone_desc["devices"]:
-                if device["nodeid"] == nodeid and device["devid"] == devid:
-                    display_name = device["display"]
-                    devicename = device["type"]
-                    value = datatype[device["type"] ](value)
-                    print("Converted value: %s" % str(value))
-                    break
-            path = "bugone." + address + "." + devicename
-            payload = pickle.dumps([(path,(timestamp,value))], protocol=2)
-            header = struct.pack("!L", len(payload))
-            final_msg = header + payload
-            print(display_name + ": " + str(final_msg))
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect( ("localhost",2004) )
-            s.send(final_msg)
-            s.close()
+        if registry.maybe_reload() and wire_format == bugonewire.FORMAT_TOPIC:
+            added = set(registry.devices()) - subscribed
+            bugonewire.subscribe(subscriber, wire_format, added)
+            subscribed |= added
+        timeout = carbon.next_flush()
+        if aggregator:
+            aggregator.tick(time.time())
+            timeout = aggregator.check_interval if timeout is None else min(timeout, aggregator.check_interval)
+        if not poller.poll(None if timeout is None else timeout * 1000):
+            carbon.tick()
+            continue
+        for message in bugonewire.recv_messages(subscriber):
+            reading = reader.read(message)
+            if reading is None:
+                continue
+            (msg, entry, value) = reading
+            print(entry.display + ": " + entry.path + " = " + str(value))
+            if aggregator and aggregator.add(entry, msg.timestamp, value):
+                continue
+            carbon.add(entry.path, msg.timestamp, value)
+        carbon.tick()
@@ -22,77 +22,18 @@ along with this program.  If not, see
 """
 
 import time
-import logging
-import logging.handlers
 import configparser
 import argparse
 import os
 import sys
 import zmq
-import bugonehelper
-import pickle
-import struct
-import voluptuous
-import yaml
-import socket
-import influxdb
-
-def format_float_value(v):
-    return float(v)/10
-
-def format_mil_value(v):
-    return float(v)/1000
-
-def format_bool_value(v):
-    return False if v == 0 else True
-
-datatype = {
-        "temperature": format_float_value,
-        "humidity": format_float_value,
-        "voltage": format_mil_value,
-        "switch": format_bool_value
-        }
-
-device = {
-        voluptuous.Optional("display"): str,
-        voluptuous.Required("type"): str,
-        voluptuous.Required("nodeid"): int,
-        voluptuous.Required("devid"): int,
-        voluptuous.Optional("format"): int
-}
-node = {
-        voluptuous.Required("location"): str,
-        voluptuous.Optional("display"): str,
-        voluptuous.Required("nodeid"): int,
-        voluptuous.Required("address"): str
-}
-
-
-
-def validate_db(db):
-    schema = voluptuous.Schema({
-        voluptuous.Optional("name"): str,
-        voluptuous.Required("nodes"): [node],
-        voluptuous.Required("devices"): [device]
-    })
-    try: 
-        schema(db)
-    except voluptuous.MultipleInvalid as e:
-        print(e)
-
-
-def extract_db(yaml_path):
-        if not os.access(os.path.expanduser(yaml_path),os.R_OK):
-            print("Error: config file not readable (%s)" % yaml_path)
-            sys.exit(1)
-        try:
-            yaml_file = open(os.path.expanduser(yaml_path),'r')
-        except:
-            print("Error while opening configuration file")
-            sys.exit(1)
-        db = yaml.load(yaml_file)
-        validate_db(db) 
-        return db
+import bugonewire
+import bugoneregistry
+import bugonemetrics
+import bugoneaggregate
+import bugonespool
+import bugonesink
+
 
 if __name__ == "__main__":
     # First, let's parse arguments
@@ -108,12 +49,24 @@ if __name__ == "__main__":
     pub_address = "127.0.0.1"
     pub_port = "40666"
     bugone_network_db = "/etc/bugone_client/bugone_network_db.yaml"
+    wire_format = bugonewire.FORMAT_LEGACY
+    metrics_address = "127.0.0.1"
+    metrics_port = None
     influx_address = "localhost"
     influx_port = "8096"
     influx_ssl = False
     influx_database = "bugone"
     influx_user = "bugone"
     influx_password = "bugone"
+    influx_batch_size = 5000
+    influx_flush_interval = 1000
+    influx_queue_size = 100000
+    influx_queue_full = "block"
+    influx_spool_dir = None
+    influx_spool_size = 512
+    aggregate = True
+    aggregate_max_devices = 4096
+    aggregate_grace = 1.0
 
 
     if args.config: 
@@ -133,6 +86,9 @@ if __name__ == "__main__":
             log_file = confparser.get('General','log_file')
             pub_address = confparser.get('Server','address')
             pub_port = confparser.get('Server','port')
+            wire_format = confparser.get('Server','format', fallback = wire_format)
+            metrics_address = confparser.get('Metrics','address', fallback = metrics_address)
+            metrics_port = confparser.get('Metrics','http_port', fallback = metrics_port)
             bugone_network_db = confparser.get('BugOne','bugone_network_db')
             influx_address = confparser.get('InfluxDB','address')
             influx_port = confparser.get('InfluxDB','port')
@@ -140,6 +96,15 @@ if __name__ == "__main__":
             influx_database = confparser.get('InfluxDB','database')
             influx_user = confparser.get('InfluxDB','user')
             influx_password = confparser.get('InfluxDB','password')
+            influx_batch_size = confparser.getint('InfluxDB','batch_size', fallback = influx_batch_size)
+            influx_flush_interval = confparser.getint('InfluxDB','flush_interval', fallback = influx_flush_interval)
+            influx_queue_size = confparser.getint('InfluxDB','queue_size', fallback = influx_queue_size)
+            influx_queue_full = confparser.get('InfluxDB','queue_full', fallback = influx_queue_full)
+            influx_spool_dir = confparser.get('InfluxDB','spool_dir', fallback = influx_spool_dir)
+            influx_spool_size = confparser.getint('InfluxDB','spool_size', fallback = influx_spool_size)
+            aggregate = confparser.getboolean('Aggregation','enabled', fallback = aggregate)
+            aggregate_max_devices = confparser.getint('Aggregation','max_devices', fallback = aggregate_max_devices)
+            aggregate_grace = confparser.getfloat('Aggregation','grace', fallback = aggregate_grace)
         except configparser.NoSectionError:
             print("Unrecognized config file format")
             sys.exit(1)
@@ -148,7 +113,16 @@ if __name__ == "__main__":
 
 
     print("DB file: ", bugone_network_db)
-    bugone_desc = extract_db(bugone_network_db)
+    metrics = bugonemetrics.Metrics("influxdb")
+    if metrics_port:
+        metrics.serve_http(metrics_address, metrics_port)
+
+    try:
+        registry = bugoneregistry.DeviceRegistry(bugone_network_db, lambda entry: bugonesink.line_prefix(entry.devicename, entry.tags))
+    except Exception as e:
+        print("Error while loading network description (%s)" % e)
+        sys.exit(1)
+    reader = bugonesink.MessageReader(registry, metrics)
 
 
 
@@ -156,47 +130,45 @@ if __name__ == "__main__":
     subscriber = context.socket(zmq.SUB)
     url = "tcp://"+pub_address+":"+pub_port
     subscriber.connect(url)
-    subscriber.setsockopt(zmq.SUBSCRIBE,b"")
-    influx_client = influxdb.InfluxDBClient(influx_address,int(influx_port),influx_user,influx_password,influx_database)
+    subscribed = set(registry.devices())
+    bugonewire.subscribe(subscriber, wire_format, subscribed)
+    spool = None
+    if influx_spool_dir:
+        spool = bugonespool.Spool(influx_spool_dir, max_bytes = influx_spool_size << 20)
+    influx_writer = bugonesink.LineProtocolWriter(influx_address, influx_port, influx_database, influx_user, influx_password,
+            influx_ssl, influx_batch_size, influx_flush_interval / 1000, influx_queue_size, influx_queue_full, precision = "ns",
+            metrics = metrics, spool = spool)
+
+    aggregator = None
+    poller = zmq.Poller()
+    poller.register(subscriber, zmq.POLLIN)
+    if aggregate:
+        # Devices with an aggregation window get one point per window: value
+        # is the mean, with min, max, count and last fields
+        def emit(entry, start, count, vmin, vmax, mean, last):
+            influx_writer.write(entry.sink, mean, int(start * bugonewire.NS), ",min=" + bugonesink.format_field(vmin) + ",max=" + bugonesink.format_field(vmax) +
+                    ",count=" + bugonesink.format_field(count) + ",last=" + bugonesink.format_field(last))
+        aggregator = bugoneaggregate.WindowAggregator(emit, aggregate_max_devices, aggregate_grace)
+        metrics.gauge("aggregate.values", lambda: aggregator.values)
+        metrics.gauge("aggregate.windows", lambda: aggregator.emitted)
 
     while True:
-        message = subscriber.recv()
-        timestamp = int.from_bytes(message[0:8], byteorder = "big")
-        msgtype = message[8]
-        nodeid = message[9]
-        if msgtype < 2:
-            devid = message[10]
-            display_name = "Device " + str(nodeid) + "," + str(devid)
-            address = "node" + str(nodeid)
-            devicename = "dev" + str(devid)
-            value = int.from_bytes(message[11:], byteorder="big")
-            for node in bugone_desc["nodes"]:
-                if node["nodeid"] == nodeid:
-                    address = node["address"]
-                    break
-            for device in bugone_desc["devices"]:
-                if device["nodeid"] == nodeid and device["devid"] == devid:
-                    display_name = device["display"]
-                    devicename = device["type"]
-                    value = datatype[device["type"] ](value)
-                    print("Converted value: %s" % str(value))
-                    break
-
-
-            data_points = [{
-                    "measurement": devicename,
-                    "tags": {
-                        "location": address,
-                        "nodeid": nodeid,
-                        "devid": devid
-                        },
-                    "time": timestamp,
-                    "fields": {
-                        "value": value
-                        },
-                    }
-            ]
-            print (time.asctime(time.gmtime(timestamp)))
-
-            influx_client.write_points(data_points,time_precision='s',database=influx_database)
-
+        if registry.maybe_reload() and wire_format == bugonewire.FORMAT_TOPIC:
+            added = set(registry.devices()) - subscribed
+            bugonewire.subscribe(subscriber, wire_format, added)
+            subscribed |= added
+        if aggregator:
+            aggregator.tick(time.time())
+            if not poller.poll(aggregator.check_interval * 1000):
+                continue
+        for message in bugonewire.recv_messages(subscriber):
+            reading = reader.read(message)
+            if reading is None:
+                continue
+            (msg, entry, value) = reading
+            print("Converted value: %s" % str(value))
+            print (time.asctime(time.gmtime(msg.timestamp)))
+
+            if aggregator and aggregator.add(entry, msg.timestamp, value):
+                continue
+            influx_writer.write(entry.sink, value, msg.timestamp_ns)
@@ -22,25 +22,90 @@ along with this program.  If not, see
 """
 
 import time
-import logging
-import logging.handlers
-import bugonehelper
+import configparser
+import argparse
+import os
+import sys
+import bugoneregistry
+import bugonewire
 import zmq
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BugOne zMQ client printing received values")
+    parser.add_argument("-c","--config")
+
+    args = parser.parse_args()
+
+    #Default values for parameters (overriden if config file is present)
+    pub_address = "192.168.42.252"
+    pub_port = "40666"
+    wire_format = bugonewire.FORMAT_LEGACY
+    bugone_network_db = None
+    snapshot_port = None
+
+    if args.config: 
+        confpath = args.config
+        if not os.access(os.path.expanduser(confpath),os.R_OK):
+            print("Error: config file not readable (%s)" % confpath)
+            sys.exit(1)
+        try: 
+            confparser = configparser.ConfigParser()
+            confparser.read(os.path.expanduser(confpath))
+            pub_address = confparser.get('Server','address')
+            pub_port = confparser.get('Server','port')
+            wire_format = confparser.get('Server','format', fallback = wire_format)
+            snapshot_port = confparser.get('Server','snapshot_port', fallback = snapshot_port)
+            bugone_network_db = confparser.get('BugOne','bugone_network_db', fallback = None)
+        except configparser.NoSectionError:
+            print("Unrecognized config file format")
+            sys.exit(1)
+
+    # Without a network description, print everything
+    devices = None
+    if bugone_network_db:
+        try:
+            bugone_desc = bugoneregistry.load_cached_db(bugone_network_db)
+        except (OSError, ValueError) as e:
+            print("Error while loading network description (%s)" % e)
+            sys.exit(1)
+        devices = [(d["nodeid"], d["devid"]) for d in bugone_desc["devices"]]
+
     context = zmq.Context()
     subscriber = context.socket(zmq.SUB)
-    subscriber.connect("tcp://192.168.42.252:40666")
-    subscriber.setsockopt(zmq.SUBSCRIBE,b"")
+    subscriber.connect("tcp://"+pub_address+":"+pub_port)
+    bugonewire.subscribe(subscriber, wire_format, devices, status = True)
 
-    while True:
-        message = subscriber.recv()
-        timestamp = int.from_bytes(message[0:8], byteorder = "big")
-        msgtype = message[8]
-        nodeid = message[9]
+    def print_message(message):
+        try:
+            (timestamp, msgtype, nodeid, devid, payload) = bugonewire.decode(message)
+        except ValueError as e:
+            print("Cannot decode message (%s)" % e)
+            return
         if msgtype < 2:
-            devid = message[10]
-            print("%s - (%s,%s) -> %s" % (time.asctime(time.localtime(timestamp)), nodeid, devid, int.from_bytes(message[11:13], byteorder = "big")))
-
+            print("%s - (%s,%s) -> %s" % (time.asctime(time.localtime(timestamp)), nodeid, devid, int.from_bytes(payload[0:2], byteorder = "big")))
+        elif msgtype == bugonewire.MSG_STATUS:
+            print("%s - node %s is %s" % (time.asctime(time.localtime(timestamp)), nodeid, "active" if payload[0] else "inactive"))
 
+    # Current values, without waiting for the nodes to send them again. We
+    # are already subscribed: live messages which are in the snapshot are
+    # recognized by their sequence number (topic format only), as long as
+    # the bridge does not restart
+    snapshot_sequence = None
+    if snapshot_port:
+        requester = context.socket(zmq.REQ)
+        requester.setsockopt(zmq.LINGER, 0)
+        requester.connect("tcp://"+pub_address+":"+snapshot_port)
+        snapshot = bugonewire.request_snapshot(requester, devices)
+        requester.close()
+        if snapshot is None:
+            print("No snapshot received, waiting for live values")
+        else:
+            (snapshot_sequence, messages) = snapshot
+            for message in messages:
+                print_message(message)
 
+    while True:
+        for message in bugonewire.recv_messages(subscriber):
+            if bugonewire.in_snapshot(bugonewire.sequence(message), snapshot_sequence):
+                continue
+            print_message(message)
@@ -23,19 +23,367 @@ along with this program.  If not, see
 
 import time
 import logging
-import logging.handlers
 import configparser
 import argparse
 import os
 import sys
+import asyncio
+import collections
 import bugone
+import bugonemetrics
+import bugonewire
 import zmq
+import zmq.asyncio
+
+
+class Publisher():
+
+    # Publish the results with the following protocol: 
+    # First the timestamp in seconds since Epoch in UTC, on 8 bytes (fit for the next "a lot" of years)
+    # Second, the type of data being published (0 = config, 1 = values, 2 = node status) (1 byte)
+    # Third one is always nodeid (1 byte)
+    # Fourth one is devid if type is config or values (1 byte), it does not exist otherwise (0 byte)
+    # Last one is variable length payload
+    # With the topic format, the timestamp goes last and a version byte
+    # comes first (see bugonewire)
+    #
+    # publish_values is called from the serial read path: it only encodes
+    # the message and puts it in a bounded queue. A task of the event loop
+    # (run) sends queued messages on a zmq.asyncio socket, so the serial
+    # path never waits for the network. When queue_size messages are
+    # waiting, policy decides which one is dropped (drop_oldest or
+    # drop_newest), and drops are counted.
+    #
+    # If batch_size is more than 1, messages are grouped in multipart zMQ
+    # messages (one message per frame), sent when batch_size messages are
+    # waiting or flush_interval seconds after the first one was queued (with
+    # flush_interval set to 0, whatever is waiting is sent at once).
+    # With the topic format, a batch only holds messages of a single device,
+    # so that zMQ prefix filtering still applies
+    #
+    # Each message gets a sequence number (sent with the topic format only),
+    # which is also given to the snapshot table, if any. Numbers start from
+    # a new session id each time the bridge starts (see bugonewire)
+    #
+    # Values are timestamped with clock(), the time (ns since Epoch) the
+    # frame was received: the bridge sets it to the arrival time of the
+    # frame being processed. The topic format keeps the ns resolution and
+    # adds the publication (ingest) time, the legacy one has seconds only.
+
+    POLICIES = ("drop_oldest", "drop_newest")
+
+    def __init__(self, socket, log, batch_size = 1, flush_interval = 0, wire_format = bugonewire.FORMAT_LEGACY, metrics = None,
+            queue_size = 10000, policy = "drop_oldest", snapshot = None):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown queue full policy (%s)" % policy)
+        self.socket = socket
+        self.log = log
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.wire_format = wire_format
+        self.snapshot = snapshot
+        self.sequence = bugonewire.new_session()
+        if snapshot:
+            snapshot.sequence = self.sequence
+        self.clock = time.time_ns
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        self.policy = policy
+        self.dropped = 0
+        self.sent = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("bridge")
+        self._send_stage = metrics.stage("zmq_send")
+        metrics.gauge("zmq.queued", lambda: len(self.queue))
+        metrics.gauge("zmq.dropped", lambda: self.dropped)
+        metrics.gauge("zmq.sent", lambda: self.sent)
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self.run())
+        return self._task
+
+    def publish_values(self,nodeid,devid,value,timestamp_ns = None):
+        self.sequence += 1
+        if timestamp_ns is None:
+            timestamp_ns = self.clock() or time.time_ns()
+        if self.wire_format == bugonewire.FORMAT_TOPIC:
+            msg = bugonewire.encode_topic_values(nodeid, devid, value, timestamp_ns, sequence = self.sequence)
+        else:
+            msg = bugonewire.encode_values(nodeid, devid, value, timestamp_ns // bugonewire.NS)
+        if self.snapshot:
+            self.snapshot.update_value(self.sequence, nodeid, devid, value, timestamp_ns)
+        self._enqueue((nodeid, devid) if self.wire_format == bugonewire.FORMAT_TOPIC else None, msg)
+
+    def publish_status(self, nodeid, status):
+        # Status transitions of a node (see bugone.LivenessTracker)
+        self.sequence += 1
+        timestamp_ns = time.time_ns()
+        if self.wire_format == bugonewire.FORMAT_TOPIC:
+            msg = bugonewire.encode_topic_status(nodeid, status, timestamp_ns, self.sequence)
+        else:
+            msg = bugonewire.encode_status(nodeid, status, timestamp_ns // bugonewire.NS)
+        if self.snapshot:
+            self.snapshot.sequence = self.sequence
+            self.snapshot.update_status(nodeid, status)
+        self._enqueue(("status", nodeid), msg)
+
+    def _enqueue(self, key, msg):
+        # key groups messages in batches (None: any message)
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            if self.policy == "drop_newest":
+                return
+            self.queue.popleft()
+        self.queue.append( (key, msg) )
+        self._wakeup.set()
+
+    async def run(self):
+        queue = self.queue
+        while True:
+            if not queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if self.batch_size > 1 and self.flush_interval > 0 and len(queue) < self.batch_size:
+                # Give the batch some time to fill
+                deadline = asyncio.get_event_loop().time() + self.flush_interval
+                while len(queue) < self.batch_size:
+                    remaining = deadline - asyncio.get_event_loop().time()
+                    if remaining <= 0:
+                        break
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+            await self.flush()
+
+    async def flush(self):
+        # Send up to batch_size waiting messages
+        queue = self.queue
+        if not queue:
+            return
+        start = bugonemetrics.perf_counter_ns()
+        if self.batch_size == 1:
+            (key, msg) = queue.popleft()
+            self.log.debug("Publishing: %s", msg)
+            await self.socket.send(msg)
+            self.sent += 1
+        else:
+            batches = {}
+            for i in range(min(len(queue), self.batch_size)):
+                (key, msg) = queue.popleft()
+                batches.setdefault(key, []).append(msg)
+            for batch in batches.values():
+                await self.socket.send_multipart(batch)
+                self.sent += len(batch)
+        self._send_stage.observe(start)
+
+    async def drain(self):
+        # Send everything still queued (e.g. before exiting)
+        while self.queue:
+            await self.flush()
+
+
+def split_envelope(frames):
+    # Routing envelope of a message received on a ROUTER socket: identities
+    # up to the empty delimiter (REQ clients), or the identity alone (DEALER
+    # clients). Returns (envelope, request frames)
+    try:
+        split = frames.index(b"") + 1
+    except ValueError:
+        split = 1
+    return (frames[:split], frames[split:])
+
+
+class SnapshotServer():
+
+    # Latest value of every device and status of every node, served on a
+    # zMQ ROUTER socket so that a client which starts does not have to wait
+    # for each node to send again (clone pattern, see bugonewire):
+    # - the client subscribes to the publisher first, and keeps what it
+    #   receives
+    # - it requests a snapshot, which holds the sequence number of the last
+    #   published message (see bugonewire.request_snapshot)
+    # - it drops live messages with a sequence number lower or equal to the
+    #   snapshot one, they are already in the snapshot
+    # Snapshot messages always use the topic format.
+
+    def __init__(self, socket, log, metrics = None):
+        self.socket = socket
+        self.log = log
+        self.sequence = 0
+        self.values = {}
+        self.status = {}
+        self.served = 0
+        self._task = None
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("bridge")
+        self._serve_stage = metrics.stage("snapshot")
+        metrics.gauge("snapshot.devices", lambda: len(self.values))
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self.run())
+        return self._task
+
+    def update_value(self, sequence, nodeid, devid, value, timestamp_ns):
+        self.sequence = sequence
+        self.values[ (nodeid, devid) ] = (sequence, timestamp_ns, value)
+
+    def update_status(self, nodeid, status):
+        self.status[nodeid] = (self.sequence, time.time_ns(), status)
+
+    def reply(self, devices = None):
+        # Frames of the reply to a request for devices (see
+        # bugonewire.decode_snapshot_request)
+        frames = [self.sequence.to_bytes(8, byteorder = "big")]
+        if devices is None:
+            keys = sorted(self.values)
+            nodes = sorted(self.status)
+        else:
+            keys = []
+            nodes = set()
+            for (nodeid, devid) in devices:
+                if devid is None:
+                    keys.extend(k for k in sorted(self.values) if k[0] == nodeid)
+                elif (nodeid, devid) in self.values:
+                    keys.append( (nodeid, devid) )
+                nodes.add(nodeid)
+            nodes = sorted(n for n in nodes if n in self.status)
+        for nodeid in nodes:
+            (sequence, timestamp_ns, status) = self.status[nodeid]
+            frames.append(bugonewire.encode_topic_status(nodeid, status, timestamp_ns, sequence))
+        for (nodeid, devid) in keys:
+            (sequence, timestamp_ns, value) = self.values[ (nodeid, devid) ]
+            frames.append(bugonewire.encode_topic_values(nodeid, devid, value, timestamp_ns, sequence = sequence))
+        return frames
+
+    async def run(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            start = bugonemetrics.perf_counter_ns()
+            (envelope, request) = split_envelope(frames)
+            try:
+                devices = bugonewire.decode_snapshot_request(request)
+            except ValueError:
+                self._serve_stage.errors += 1
+                self.log.warning("Invalid snapshot request")
+                continue
+            await self.socket.send_multipart(envelope + self.reply(devices))
+            self.served += 1
+            self._serve_stage.observe(start)
+
+
+class CommandServer():
+
+    # GET/SET requests received on a zMQ ROUTER socket (see bugonewire),
+    # handed to a bugonecommand.CommandScheduler. Each request is handled by
+    # its own task, so that requests to different nodes are in flight at the
+    # same time
+
+    def __init__(self, socket, scheduler, log, metrics = None):
+        self.socket = socket
+        self.scheduler = scheduler
+        self.log = log
+        self._task = None
+        if metrics is None:
+            metrics = bugonemetrics.Metrics("bridge")
+        self._command_stage = metrics.stage("command")
+        metrics.gauge("commands", scheduler.stats)
+
+    def start(self):
+        self._task = asyncio.get_event_loop().create_task(self.run())
+        return self._task
+
+    async def run(self):
+        while True:
+            frames = await self.socket.recv_multipart()
+            (envelope, request) = split_envelope(frames)
+            try:
+                (request_id, command, nodeid, devid, value) = bugonewire.decode_command(request)
+            except ValueError as e:
+                self._command_stage.errors += 1
+                reply = bugonewire.encode_command_reply(request[0] if request else b"", bugonewire.COMMAND_ERROR, str(e).encode())
+                await self.socket.send_multipart(envelope + reply)
+                continue
+            asyncio.get_event_loop().create_task(self.handle(envelope, request_id, command, nodeid, devid, value))
+
+    async def handle(self, envelope, request_id, command, nodeid, devid, value):
+        start = bugonemetrics.perf_counter_ns()
+        self.log.info("%s (%s.%s) %s", command.decode(), nodeid, devid, repr(value))
+        try:
+            if command == bugonewire.COMMAND_GET:
+                result = await self.scheduler.get(nodeid, devid)
+            else:
+                if len(value) == 2:
+                    value = int.from_bytes(value, byteorder = "big")
+                result = await self.scheduler.set(nodeid, devid, value)
+            reply = bugonewire.encode_command_reply(request_id, bugonewire.COMMAND_OK, bytes(result))
+            self._command_stage.observe(start)
+        except asyncio.TimeoutError:
+            self._command_stage.errors += 1
+            reply = bugonewire.encode_command_reply(request_id, bugonewire.COMMAND_TIMEOUT)
+        except (OSError, ValueError) as e:
+            self._command_stage.errors += 1
+            reply = bugonewire.encode_command_reply(request_id, bugonewire.COMMAND_ERROR, str(e).encode())
+        await self.socket.send_multipart(envelope + reply)
+
+
+# Self-monitoring: values published for the bridge's own virtual node
+# (devid is the position in this list, starting at 1, value on 4 bytes)
+SELF_MONITORING = (
+        ("stages", "serial_read"),
+        ("stages", "process_data"),
+        ("stages", "zmq_send"),
+        ("gauges", "reassembly.resyncs"),
+        ("gauges", "checksum.errors"),
+        ("gauges", "deadband.suppressed"),
+        ("gauges", "liveness.alive"),
+        )
+
+
+def parse_thresholds(text):
+    # "nodeid.devid=threshold, ..." -> {(nodeid, devid): threshold}
+    thresholds = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        (device, threshold) = item.split("=")
+        (nodeid, devid) = device.split(".")
+        thresholds[ (int(nodeid), int(devid)) ] = int(threshold)
+    return thresholds
+
+def parse_intervals(text):
+    # "nodeid=seconds, ..." -> {nodeid: seconds}
+    intervals = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        (nodeid, interval) = item.split("=")
+        intervals[int(nodeid)] = float(interval)
+    return intervals
+
+def check_liveness(liveness):
+    liveness.check()
+    asyncio.get_event_loop().call_later(liveness.next_check(), check_liveness, liveness)
+
+def publish_metrics(pub, metrics, nodeid, interval):
+    snapshot = metrics.snapshot()
+    for (devid, (kind, name)) in enumerate(SELF_MONITORING, 1):
+        value = snapshot[kind].get(name) or 0
+        if kind == "stages":
+            value = value["count"]
+        pub.publish_values(nodeid, devid, (value & 0xFFFFFFFF).to_bytes(4, byteorder = "big"), time.time_ns())
+    asyncio.get_event_loop().call_later(interval, publish_metrics, pub, metrics, nodeid, interval)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="BugOne network bridge to zMQ")
     parser.add_argument("-v","--verbose",action="store_true",help="Verbose output")
     parser.add_argument("-c","--config")
+    parser.add_argument("--replay",metavar="DIR",help="Publish frames from a capture directory instead of the serial port")
+    parser.add_argument("--realtime",action="store_true",help="Replay frames at their original pace (default: as fast as possible)")
 
     args = parser.parse_args()
     verbose = args.verbose
@@ -45,8 +393,39 @@ if __name__ == "__main__":
     serial_port = "/dev/ttyUSB0"
     serial_baudrate = "38400"
     serial_reconnect = False
+    serial_number_can_change = False
+    reconnect_min = 0.1
+    reconnect_max = 5.0
+    capture_dir = None
+    dedup_window = 2.0
     pub_address = "localhost"
     pub_port = "40666"
+    batch_size = 1
+    batch_interval = 0
+    wire_format = bugonewire.FORMAT_LEGACY
+    queue_size = 10000
+    queue_full = "drop_oldest"
+    snapshot_port = None
+    metrics_address = "127.0.0.1"
+    metrics_port = None
+    metrics_node = 0
+    metrics_interval = 60
+    deadband_enabled = False
+    deadband = 0
+    deadband_heartbeat = 300
+    deadband_thresholds = ""
+    liveness_enabled = False
+    liveness_missed = 3
+    liveness_min_timeout = 60
+    liveness_max_timeout = 3600
+    liveness_intervals = ""
+    command_address = "127.0.0.1"
+    command_port = None
+    command_node_id = 0
+    command_rate = 2.0
+    command_burst = 5
+    command_timeout = 2.0
+    command_retries = 1
 
     if args.config: 
         confpath = args.config
@@ -66,14 +445,62 @@ if __name__ == "__main__":
             serial_port = confparser.get('BugOne','serial_port')
             serial_baudrate = confparser.get('BugOne','baudrate')
             serial_reconnect = confparser.getboolean('BugOne','reconnect')
+            serial_number_can_change = confparser.getboolean('BugOne','number_can_change', fallback = serial_number_can_change)
+            reconnect_min = confparser.getfloat('BugOne','reconnect_min', fallback = reconnect_min)
+            reconnect_max = confparser.getfloat('BugOne','reconnect_max', fallback = reconnect_max)
+            capture_dir = confparser.get('BugOne','capture_dir', fallback = None)
+            dedup_window = confparser.getfloat('BugOne','dedup_window', fallback = dedup_window)
             pub_address = confparser.get('Server','address')
             pub_port = confparser.get('Server','port')
+            batch_size = confparser.getint('Server','batch_size', fallback = batch_size)
+            batch_interval = confparser.getint('Server','batch_interval', fallback = batch_interval)
+            wire_format = confparser.get('Server','format', fallback = wire_format)
+            queue_size = confparser.getint('Server','queue_size', fallback = queue_size)
+            queue_full = confparser.get('Server','queue_full', fallback = queue_full)
+            snapshot_port = confparser.get('Server','snapshot_port', fallback = snapshot_port)
+            metrics_address = confparser.get('Metrics','address', fallback = metrics_address)
+            metrics_port = confparser.get('Metrics','http_port', fallback = metrics_port)
+            metrics_node = confparser.getint('Metrics','self_node', fallback = metrics_node)
+            metrics_interval = confparser.getint('Metrics','interval', fallback = metrics_interval)
+            deadband_enabled = confparser.getboolean('Deadband','enabled', fallback = deadband_enabled)
+            deadband = confparser.getint('Deadband','deadband', fallback = deadband)
+            deadband_heartbeat = confparser.getfloat('Deadband','heartbeat', fallback = deadband_heartbeat)
+            deadband_thresholds = confparser.get('Deadband','thresholds', fallback = deadband_thresholds)
+            liveness_enabled = confparser.getboolean('Liveness','enabled', fallback = liveness_enabled)
+            liveness_missed = confparser.getfloat('Liveness','missed', fallback = liveness_missed)
+            liveness_min_timeout = confparser.getfloat('Liveness','min_timeout', fallback = liveness_min_timeout)
+            liveness_max_timeout = confparser.getfloat('Liveness','max_timeout', fallback = liveness_max_timeout)
+            liveness_intervals = confparser.get('Liveness','intervals', fallback = liveness_intervals)
+            command_address = confparser.get('Commands','address', fallback = command_address)
+            command_port = confparser.get('Commands','port', fallback = command_port)
+            command_node_id = confparser.getint('Commands','node_id', fallback = command_node_id)
+            command_rate = confparser.getfloat('Commands','rate', fallback = command_rate)
+            command_burst = confparser.getint('Commands','burst', fallback = command_burst)
+            command_timeout = confparser.getfloat('Commands','timeout', fallback = command_timeout)
+            command_retries = confparser.getint('Commands','retries', fallback = command_retries)
         except configparser.NoSectionError:
             print("Unrecognized config file format")
             sys.exit(1)
     else:
         print("Using default arguments")
 
+    if wire_format not in bugonewire.FORMATS:
+        print("Unknown message format (%s)" % wire_format)
+        sys.exit(1)
+
+    last_values = None
+    if deadband_enabled:
+        try:
+            last_values = bugone.LastValueCache(deadband, deadband_heartbeat, parse_thresholds(deadband_thresholds))
+        except ValueError:
+            print("Invalid deadband thresholds (%s)" % deadband_thresholds)
+            sys.exit(1)
+    try:
+        liveness_intervals = parse_intervals(liveness_intervals)
+    except ValueError:
+        print("Invalid liveness intervals (%s)" % liveness_intervals)
+        sys.exit(1)
+
 
     logger = logging.getLogger("BugOneBridge")
     if verbose:
@@ -88,30 +515,80 @@ if __name__ == "__main__":
 
     logger.addHandler(handler)
 
-    context = zmq.Context()
+    context = zmq.asyncio.Context()
     publisher = context.socket(zmq.PUB)
     pub_url = "tcp://"+pub_address+":"+pub_port
     print("Connecting to address %s..." % pub_url)
     publisher.bind(pub_url)
+    snapshot = None
+    if snapshot_port:
+        snapshot_socket = context.socket(zmq.ROUTER)
+        snapshot_url = "tcp://"+pub_address+":"+snapshot_port
+        print("Serving snapshots on %s..." % snapshot_url)
+        snapshot_socket.bind(snapshot_url)
+    if command_port:
+        command_socket = context.socket(zmq.ROUTER)
+        command_url = "tcp://"+command_address+":"+command_port
+        print("Accepting commands on %s..." % command_url)
+        if command_address not in ("127.0.0.1", "localhost", "::1"):
+            # Anyone who can reach the socket can set actuators
+            print("Warning: the command socket has no authentication and is not bound to localhost")
+        command_socket.bind(command_url)
     print("Done, starting the bridge")
 
-    def publish_values(nodeid,devid,value):
-        # Publish the results with the following protocol: 
-        # First the timestamp in seconds since Epoch in UTC, on 8 bytes (fit for the next "a lot" of years)
-        # Second, the type of data being published (0 = config, 1 = values, 2 = node status) (1 byte)
-        # Third one is always nodeid (1 byte)
-        # Fourth one is devid if type is config or values (1 byte), it does not exist otherwise (0 byte)
-        # Last one is variable length payload
-        msg = b""
-        msg = msg + int(time.time()).to_bytes(8,byteorder = "big")
-        msg = msg + bytes([1])
-        msg = msg + bytes([nodeid])
-        msg = msg + bytes([devid])
-        msg = msg + value
-        logger.debug("Publishing: %s" % (msg))
-        publisher.send(msg)
-
-    bug = bugone.BugOne(serial_port, serial_reconnect, serial_baudrate, logger, publish_values)
+    metrics = bugonemetrics.Metrics("bridge")
+    if metrics_port:
+        metrics.serve_http(metrics_address, metrics_port)
+    if snapshot_port:
+        snapshot = SnapshotServer(snapshot_socket, logger, metrics)
+        snapshot.start()
+    pub = Publisher(publisher, logger, batch_size, batch_interval / 1000, wire_format, metrics, queue_size, queue_full, snapshot)
+    pub.start()
+    status_cb = snapshot.update_status if snapshot else None
+    liveness = None
+    if liveness_enabled:
+        liveness = bugone.LivenessTracker(pub.publish_status, liveness_missed, liveness_min_timeout, liveness_max_timeout,
+                liveness_intervals)
+        asyncio.get_event_loop().call_later(liveness.next_check(), check_liveness, liveness)
+    if metrics_node:
+        asyncio.get_event_loop().call_later(metrics_interval, publish_metrics, pub, metrics, metrics_node, metrics_interval)
 
-    bug.start()
+    # Modules used by optional features are imported when they are enabled
+    if args.replay:
+        import bugonecapture
+        bug = bugone.BugOne(serial_port, serial_reconnect, serial_baudrate, logger, pub.publish_values, metrics = metrics, deadband = last_values,
+                status_cb = status_cb, liveness = liveness)
+        # Values keep the time they were captured
+        pub.clock = lambda: bug.frame_time_ns
+        start = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        count = loop.run_until_complete(bug.replay(bugonecapture.CaptureReader(args.replay), args.realtime))
+        loop.run_until_complete(pub.drain())
+        loop.close()
+        elapsed = time.perf_counter() - start
+        print("Replayed %d frames in %.3fs (%.0f frames/s)" % (count, elapsed, count / elapsed if elapsed else 0))
+        sys.exit(0)
+
+    # Several sniffers can be given, separated by commas
+    serial_ports = [p.strip() for p in serial_port.split(",") if p.strip()]
+    if len(serial_ports) == 1:
+        serial_ports = serial_ports[0]
+
+    capture = None
+    if capture_dir:
+        import bugonecapture
+        capture = bugonecapture.CaptureWriter(os.path.expanduser(capture_dir))
 
+    bug = bugone.BugOne(serial_ports, serial_reconnect, serial_baudrate, logger, pub.publish_values, capture, metrics, dedup_window, last_values,
+            status_cb, serial_number_can_change, reconnect_min, reconnect_max, liveness)
+    pub.clock = lambda: bug.frame_time_ns
+
+    if command_port:
+        import bugonecommand
+        scheduler = bugonecommand.CommandScheduler(bug.send_packet, command_rate, command_burst,
+                command_timeout, command_retries, command_node_id)
+        bug.commands = scheduler
+        scheduler.start()
+        CommandServer(command_socket, scheduler, logger, metrics).start()
+
+    bug.start()